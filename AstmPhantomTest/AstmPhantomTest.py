@@ -170,6 +170,7 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.pointAcqui1frameButton.connect('clicked()', self.onPointAcqui1frameSet)
       self.ui.pointAcquiMeanButton.connect('clicked()', self.onPointAcquiMeanSet)
       self.ui.pointAcquiMedianButton.connect('clicked()', self.onPointAcquiMedianSet)
+      self.ui.pointAcquiRobustButton.connect('clicked()', self.onPointAcquiRobustSet)
       self.ui.pointAcquiDurationLineEdit.connect('editingFinished()', self.onPointAcquiDurationChanged)
       self.ui.pointAcquiNumFramesLineEdit.connect('editingFinished()', self.onPointAcquiNumFramesChanged)
       self.ui.operatorLineEdit.connect('editingFinished()', self.onOperatorIdChanged)
@@ -192,6 +193,7 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.resetStepButton.connect('clicked()', self.logic.resetStep)
       self.ui.anglesCheckbox.connect('stateChanged(int)', self.logic.anglesCheckboxChanged)
       self.ui.recalibOptionCheckBox.connect('stateChanged(int)', self.logic.setRecalibAtLocation)
+      self.ui.pivotCalibButton.connect('toggled(bool)', self.onPivotCalibToggled)
 
       self.ui.hackCalibButton.connect('clicked()', self.hackCalib)
       self.ui.hackCLButton.connect('clicked()', self.hackCL)
@@ -224,6 +226,12 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.logic.AddObserver(self.logic.testFinished, self.onTestFinished)
       self.logic.AddObserver(self.logic.sessionEndedEvent, self.onSessionEnded)
 
+      # Refresh the tracker stream rates every second
+      self.streamTimer = qt.QTimer()
+      self.streamTimer.setInterval(1000)
+      self.streamTimer.connect('timeout()', self.onStreamTimer)
+      self.streamTimer.start()
+
       # Initialize default values for UI elements
       self.ui.movingTolValue.setText(f'{self.logic.pointer.movingTol:.2f} mm')
       self.onMovingTolChangedFromLocation(self.logic.pointer) # update slider with pointer moving tol default value
@@ -353,8 +361,12 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.pointAcquiVerticalLine.enabled = False
     self.ui.pointAcquiMeanButton.enabled = False
     self.ui.pointAcquiMedianButton.enabled = False
+    self.ui.pointAcquiRobustButton.enabled = False
     self.ui.pointAcquiNumFramesLineEdit.enabled = False
     self.ui.pointAcquiFramesLabel.enabled = False
+    # the tip must not change while the ground truth is picked
+    self.ui.pivotCalibButton.checked = False  # finishes a recording in progress
+    self.ui.pivotCalibButton.enabled = False
     self.ui.hackCalibButton.enabled = True
     
     if self.logic.skipCalibMode:
@@ -679,22 +691,37 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.pointAcquiVerticalLine.enabled = True
         self.ui.pointAcquiMeanButton.enabled = True
         self.ui.pointAcquiMedianButton.enabled = True
-        self.ui.pointAcquiDurationLineEdit.text = str(self.logic.pointer.timerDuration)
+        self.ui.pointAcquiRobustButton.enabled = True
+        self.ui.pointAcquiDurationLineEdit.text = str(self.logic.pointer.acquiDuration)
         self.ui.pointAcquiNumFramesLineEdit.text = str(self.logic.pointer.numFrames)
         # Enable other options
         self.ui.operatorLineEdit.enabled = True
         self.ui.recalibOptionCheckBox.enabled = True
+        self.ui.pivotCalibButton.enabled = True
 
     self.logic.trackerId = tk
     logging.info(f"Tracker Serial Number: {self.logic.trackerId}")
 
+  def onPivotCalibToggled(self, checked):
+    if checked:
+      self.ui.pivotCalibButton.text = "Stop and Solve"
+      self.ui.pivotCalibValue.text = "recording..."
+      self.logic.pointer.startPivotCalibration()
+    else:
+      self.ui.pivotCalibButton.text = "Start Recording"
+      res = self.logic.finishPivotCalibration()
+      if res is None:
+        self.ui.pivotCalibValue.text = "failed, try again"
+      else:
+        self.ui.pivotCalibValue.text = f"RMS = {res['rms']:.2f} mm"
+
   def onPointAcqui1frameSet(self):
     self.ui.pointAcquiDurationLineEdit.enabled = True
     self.ui.pointAcquiMillisecLabel.enabled = True
     self.ui.pointAcquiNumFramesLineEdit.enabled = False
     self.ui.pointAcquiFramesLabel.enabled = False
     self.logic.pointer.acquiMode = 0
-    logging.info(f"Point acquisition set to 1-frame from a {self.logic.pointer.timerDuration}ms point acquisition")
+    logging.info(f"Point acquisition set to 1-frame from a {self.logic.pointer.acquiDuration}ms point acquisition")
   
   def onPointAcquiMeanSet(self):
     self.ui.pointAcquiDurationLineEdit.enabled = False
@@ -712,11 +739,19 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic.pointer.acquiMode = 2
     logging.info(f"Point acquisition set to MEDIAN across {self.logic.pointer.numFrames} frames")
 
+  def onPointAcquiRobustSet(self):
+    self.ui.pointAcquiDurationLineEdit.enabled = False
+    self.ui.pointAcquiMillisecLabel.enabled = False
+    self.ui.pointAcquiNumFramesLineEdit.enabled = True
+    self.ui.pointAcquiFramesLabel.enabled = True
+    self.logic.pointer.acquiMode = 3
+    logging.info(f"Point acquisition set to ROBUST MEAN across {self.logic.pointer.numFrames} frames")
+
   def onPointAcquiDurationChanged(self):
     val = int(self.ui.pointAcquiDurationLineEdit.text)
-    if val != self.logic.pointer.timerDuration:
-      self.logic.pointer.timerDuration = val
-      logging.info(f"Timer duration for point acquisition set to {self.logic.pointer.timerDuration}ms")
+    if val != self.logic.pointer.acquiDuration:
+      self.logic.pointer.acquiDuration = val
+      logging.info(f"Duration of point acquisition set to {self.logic.pointer.acquiDuration}ms")
 
   def onPointAcquiNumFramesChanged(self):
     val = int(self.ui.pointAcquiNumFramesLineEdit.text)
@@ -744,6 +779,20 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ptrNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, \
         self.onNodeChanged)
 
+  def onStreamTimer(self):
+    """
+    Displays the update rate of the transform nodes, details in the tooltips
+    """
+    for name, qlabel in [('PointerToTracker', self.ui.ptrRateValue), ('PhantomToTracker', self.ui.refRateValue),
+      ('PointerToPhantom', self.ui.ptrRefRateValue)]:
+      m = self.logic.frames.monitor(name)
+      if m is None:
+        continue
+      qlabel.text = f"({m.recentRate():.0f} Hz)"
+      s = m.stats()
+      qlabel.toolTip = (f"{s['rate']:.1f} Hz on average, dt = {s['mean dt']:.1f} \u00b1 {s['jitter']:.1f} ms "
+        f"(max {s['max dt']:.0f} ms), {s['gaps']} gaps, ~{s['dropped']} frames dropped")
+
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeChanged(self, caller, event=None, calldata=None):
     """
@@ -798,6 +847,8 @@ class AstmPhantomTestWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if hasattr(self, 'streamTimer'):
+      self.streamTimer.stop()
 
   def enter(self):
     """
@@ -918,9 +969,12 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     self.phantom = Phantom(self.mainRenderer)
     self.skipCalibMode = False
     self.calibratingPhantom = False
+    # Tracker stream (transforms of each tracker frame, read once)
+    self.frames = FrameAssembler()
     # Pointer
     self.pointer = Pointer()
     self.pointer.maxTilt = 50
+    self.pointers = [self.pointer]  # main pointer first, then the ones added with addPointer
     if self.mainRenderer is not None: # if rendering is enabled
       self.pointer.readModel(self.pointerModelPath)
     # Targets
@@ -956,6 +1010,11 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     #   Distance accuracy test
     self.distMeasurement = DistMeasurement()
     self.recalibAtLocation = True
+    # if True, the session json stores large arrays as base64 blocks (see NumpyBinaryEncoder)
+    self.binaryJson = False
+    # if True, the latencies of the pointer frame handlers and of their observers
+    # are recorded and written alongside the session data (see Profiler)
+    profiler.enabled = False
 
   def process(self, ptrRefTransfoNode, refTransfoNode, ptrTransfoNode):
     """
@@ -979,8 +1038,10 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     else:
       self.ptrTransfoNode = ptrTransfoNode
 
-    # forward the transforms given by the tracker to the pointer model
-    self.pointer.setTransfoNodes(ptrRefTransfoNode, ptrTransfoNode)
+    # gather the transforms of each tracker frame, and forward them to the pointer model
+    # (added to those of the pointers added with addPointer, whose indexes stay valid)
+    self.frames.addNodes([ptrRefTransfoNode, ptrTransfoNode, refTransfoNode])
+    self.pointer.setTransfoNodes(ptrRefTransfoNode, ptrTransfoNode, self.frames)
     # hide pointer model until phantom calibrated
     self.pointer.model.GetDisplayNode().VisibilityOff()
     # assign reference transform to simp phantom
@@ -1009,6 +1070,29 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
 
     logging.info('All set !')
 
+  def addPointer(self, ptrRefTransfoNode, ptrTransfoNode, path = None):
+    """
+    Adds a pointer (without model display), e.g. a second pointer or a reference probe
+    to compare with the main one. Its transforms are read in the same tracker frames
+    as those of the other pointers. Returns the new pointer.
+    """
+    if not ptrRefTransfoNode or not ptrTransfoNode:
+      raise ValueError("pointer transforms are invalid")
+    ptr = Pointer()
+    ptr.maxTilt = self.pointer.maxTilt
+    if path:
+      ptr.readPointerFile(path)
+    else:
+      ptr.checkPtrAxes()
+    ptr.trkRollAxis = self.pointer.trkRollAxis
+    ptr.trkPitchAxis = self.pointer.trkPitchAxis
+    ptr.trkYawAxis = self.pointer.trkYawAxis
+    ptr.checkTrkAxes()
+    ptr.setTransfoNodes(ptrRefTransfoNode, ptrTransfoNode, self.frames)
+    self.pointers.append(ptr)
+    logging.info(f'Pointer {ptr.id} added ({ptrTransfoNode.GetName()})')
+    return ptr
+
   def resetCam(self):
     if self.mainWidget.isVisible():
       if self.calibratingPhantom:
@@ -1040,7 +1124,7 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
   
   @vtk.calldata_type(vtk.VTK_STRING)
   def onPointerAnglesChanged(self, caller, event=None, calldata=None):
-      cd = ast.literal_eval(calldata)
+      cd = caller.eventData['angles']
       self.angleAnn.SetText(2, f"Roll={cd[0]:.1f}\nPitch={cd[1]:.1f}\nYaw={cd[2]:.1f}")
   
   @vtk.calldata_type(vtk.VTK_STRING)
@@ -1117,6 +1201,17 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     else:
       return False
 
+  def finishPivotCalibration(self):
+    res = self.pointer.finishPivotCalibration()
+    if res is not None:
+      # store the result with the pointer id
+      dts = datetime.now().strftime("%Y.%m.%d_%H.%M.%S")
+      pivotPath = self.savePath + f"/PivotCalibration_{self.pointer.id}_{dts}.json"
+      with open(pivotPath, 'w') as jsonFile:
+        logging.info(f'Writing pivot calibration in {pivotPath} (tip offset reusable as TIP in the pointer file)')
+        jsonFile.write(json.dumps(res, indent = 2, cls=NumpyEncoder))
+    return res
+
   def readWorkingVolumeFile(self, path):
     if self.workingVolume.readWorkingVolumeFile(path):
       # Remove previous targets
@@ -1125,11 +1220,12 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
       # Add the new ones
       for k in self.workingVolume.locs:
         self.addWorkingVolumeTarget(k)
-      # Forward to pointer the tracker axes for standard referential frame
-      self.pointer.trkRollAxis = self.workingVolume.rollAxis
-      self.pointer.trkPitchAxis = self.workingVolume.pitchAxis
-      self.pointer.trkYawAxis = self.workingVolume.yawAxis
-      self.pointer.checkTrkAxes()
+      # Forward to pointers the tracker axes for standard referential frame
+      for ptr in self.pointers:
+        ptr.trkRollAxis = self.workingVolume.rollAxis
+        ptr.trkPitchAxis = self.workingVolume.pitchAxis
+        ptr.trkYawAxis = self.workingVolume.yawAxis
+        ptr.checkTrkAxes()
       return True
     else:
       return False
@@ -1182,7 +1278,7 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     self.phantom.model.GetDisplayNode().VisibilityOn()
 
     # if another acquisition was already started
-    self.pointer.timer.stop()
+    self.pointer.stopAcquiring()
     self.targets.RemoveAllObservers()
     self.targets.removeAllTargets()  # making sure targets is empty
 
@@ -1540,7 +1636,7 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onRotPointerAnglesChanged(self, caller, event=None, calldata=None):
-    cd = ast.literal_eval(calldata)
+    cd = caller.eventData['angles']
     if self.curRotAxis == 0:
       self.angleAnn.SetText(2, f">Roll={cd[0]:.1f}<\n  Pitch={cd[1]:.1f}\n  Yaw={cd[2]:.1f}")
     elif self.curRotAxis == 1:
@@ -1549,8 +1645,8 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
       self.angleAnn.SetText(2, f"  Roll={cd[0]:.1f}\n  Pitch={cd[1]:.1f}\n>Yaw={cd[2]:.1f}<")
     else:
       self.angleAnn.SetText(2, '~(*_*)~')
-    self.rotAng = cd[self.curRotAxis]
-    self.rotPos = cd[3:]
+    self.rotAng = float(cd[self.curRotAxis])
+    self.rotPos = caller.eventData['pos'].copy()  # the event record is reused
     if self.rotTestAcquiring:
       # compare the current angle to that from the last sample
       # the first angle sign prevents sampling backwards
@@ -1558,12 +1654,10 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
       lastA = self.curRotMeas.measurements[self.curLoc][-1,0]
       if firstA < 0 and self.rotAng - lastA > self.curRotMeas.angStep or \
         firstA > 0 and lastA - self.rotAng > self.curRotMeas.angStep:
-          logging.info(f"  {self.curRotAxisName} rotation sampled at {self.rotAng:.1f} "
-            f"=> pos {np.around(self.rotPos, 2).tolist()}")
           # store measurement
-          self.curRotMeas.measurements[self.curLoc] = np.append(
-            self.curRotMeas.measurements[self.curLoc],
-            [np.append(self.rotAng, self.rotPos)], axis = 0)
+          span = self.curRotMeas.addSample(self.rotAng, self.rotPos)
+          logging.info(f"  {self.curRotAxisName} rotation sampled at {self.rotAng:.1f} "
+            f"=> pos {np.around(self.rotPos, 2).tolist()} (span {span:.2f})")
     
   @vtk.calldata_type(vtk.VTK_STRING)
   def onPointerTrackingStarted(self, caller, event=None, calldata=None):
@@ -1574,9 +1668,7 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
       # store the first measurement
       logging.info(f"  {self.curRotAxisName} rotation sampled at {self.rotAng:.1f} "
         f"=> pos {np.around(self.rotPos, 2).tolist()}")
-      self.curRotMeas.measurements[self.curLoc] = np.append(
-        self.curRotMeas.measurements[self.curLoc],
-        [np.append(self.rotAng, self.rotPos)], axis = 0)
+      self.curRotMeas.addSample(self.rotAng, self.rotPos)
       self.rotTestAcquiring = True
 
   @vtk.calldata_type(vtk.VTK_STRING)
@@ -1677,11 +1769,13 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     td = self.endTime - self.startTime # time delta
     durStr = f"{td.days*24+td.seconds//3600}h{td.seconds%3600//60}min{td.seconds%60}s"
     if self.pointer.acquiMode == 0:
-      pointAcquiMode = f"1-frame ({self.pointer.timerDuration}ms)"
+      pointAcquiMode = f"1-frame ({self.pointer.acquiDuration}ms)"
     elif self.pointer.acquiMode == 1:
       pointAcquiMode = f"Mean ({self.pointer.numFrames} frames)"
     elif self.pointer.acquiMode == 2:
       pointAcquiMode = f"Median ({self.pointer.numFrames} frames)"
+    elif self.pointer.acquiMode == 3:
+      pointAcquiMode = f"Robust mean ({self.pointer.numFrames} frames, {self.pointer.robustGate} robust std devs)"
     else:
       pointAcquiMode = "unknown"
 
@@ -1690,8 +1784,9 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
     else:
       recalibAtLocation_str = "No"
 
-    obj = json.dumps({"Tracker Serial Number": self.trackerId,
+    sessionData = {"Tracker Serial Number": self.trackerId,
       "Pointer": self.pointer.id,
+      "Additional Pointers": [ptr.id for ptr in self.pointers[1:]],
       "Working Volume": self.workingVolume.id,
       "Phantom": self.phantom.id,
       "Operator": self.operatorId,
@@ -1700,20 +1795,33 @@ class AstmPhantomTestLogic(ScriptedLoadableModuleLogic, vtk.vtkObject):
       "Central Divot": self.phantom.centralDivot,
       "Point acquisition": pointAcquiMode,
       "Recalibration at each location": recalibAtLocation_str,
+      "Tracker Stream": self.frames.streamStats(),
+      "Pointer Tip Offset": self.pointer.tipOffset,
+      "Pivot Calibration": self.pointer.pivotCalib,
       "Calibrated Ground Truth": self.phantom.allCalGtPts,
       f"Single Point Measurements [{self.singlePointMeasurements[0].refOriName}]": self.singlePointMeasurements[0].measurements,
       f"Single Point Measurements [{self.singlePointMeasurements[1].refOriName}]": self.singlePointMeasurements[1].measurements,
       f"Single Point Measurements [{self.singlePointMeasurements[2].refOriName}]": self.singlePointMeasurements[2].measurements,
+      f"Single Point Ellipsoids [{self.singlePointMeasurements[0].refOriName}]": self.singlePointMeasurements[0].ellipsoids(),
+      f"Single Point Ellipsoids [{self.singlePointMeasurements[1].refOriName}]": self.singlePointMeasurements[1].ellipsoids(),
+      f"Single Point Ellipsoids [{self.singlePointMeasurements[2].refOriName}]": self.singlePointMeasurements[2].ellipsoids(),
       f"{self.rotMeasurements[0].rotAxisName} Rotation Measurements": self.rotMeasurements[0].measurements,
       f"{self.rotMeasurements[1].rotAxisName} Rotation Measurements": self.rotMeasurements[1].measurements,
       f"{self.rotMeasurements[2].rotAxisName} Rotation Measurements": self.rotMeasurements[2].measurements,
-      "Multi-point Measurements": self.distMeasurement.measurements},
-      indent = 2,
-      cls=NumpyEncoder) # important to use the custom class to handle nd-array serialization
+      "Multi-point Measurements": self.distMeasurement.measurements}
+    # important to use the custom classes to handle nd-array serialization
+    if self.binaryJson:
+      obj = json.dumps(sessionData, cls=NumpyBinaryEncoder)
+    else:
+      obj = json.dumps(sessionData, indent = 2, cls=NumpyEncoder)
     with open(jsonPath, 'w') as jsonFile:
       logging.info(f'Writing all measurements in {jsonPath}')
       jsonFile.write(obj)
       jsonFile.close()
+    if profiler.enabled:
+      profPath = self.savePath + f"/AstmPhantomTest_profile_{dts}.json"
+      logging.info(f'Writing profiling data in {profPath}')
+      profiler.dump(profPath)
 
     # Generating report in HTML
     # Stack all values
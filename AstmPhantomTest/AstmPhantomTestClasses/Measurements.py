@@ -4,9 +4,8 @@ import numpy as np
 import math
 import random
 import slicer  # for error popup
-import itertools  # for combinations of divots
 import json
-from .Utils import Dist, rmsDist, RMS, Span, stdDist
+from .Utils import rmsDist, RMS, distToRef, pairwiseDist, PointStatsAccumulator, SpanTracker, covEigen
 
 #
 # Single Point Measurement class
@@ -22,10 +21,15 @@ class SinglePointMeasurement(vtk.vtkObject):
     self.stats1Changed = vtk.vtkCommand.UserEvent + 1
     self.stats2Changed = vtk.vtkCommand.UserEvent + 2
     self.curLoc = None
+    self.divot = None
+    # online stats of the measurements at the current location
+    self.acc = PointStatsAccumulator()
 
   # Set calibrated points as ground truth
   def setGtPts(self, gtPts):
     self.gtPts = gtPts
+    if self.divot in self.gtPts:
+      self.acc.setRef(self.gtPts[self.divot])
 
   # Reset all stored values, including overall errors and stats
   def fullReset(self, gtPts, divot = None):
@@ -52,33 +56,27 @@ class SinglePointMeasurement(vtk.vtkObject):
     self.acquiNum = 0
     # average measured position, used for comparison in rotation tests
     self.avgPos = None
+    self.acc.reset()
+    if self.divot in self.gtPts:
+      self.acc.setRef(self.gtPts[self.divot])
 
   def onDivDone(self, pos):
     self.acquiNum = self.acquiNum + 1
     self.measurements[self.curLoc] = np.append(self.measurements[self.curLoc],
       pos.reshape(1,-1), axis=0)
+    self.acc.push(pos)
     if self.acquiNum < self.acquiNumMax:
       logging.info(f"   {self.acquiNumMax - self.acquiNum} acquisition(s) left "
         f"for central divot #{self.divot}")
     self.updatePrecisionStats()
     self.updateAccuracyStats()
 
-  def __accuracyStats(self, measurements):
-    if len(measurements) > 0:
-      # update the average position
-      self.avgPos = np.mean(measurements, axis = 0)
-      # /!\ the length of the average error vector, not the average of errors
-      err = Dist(self.avgPos, self.gtPts[self.divot])
-      maxerr = 0
-      for m in measurements:
-        maxerr = max(maxerr, Dist(m, self.gtPts[self.divot]))
-      return {'num':len(measurements), 'avg err':err, 'max':maxerr}
-    else:
-      return {'num':0, 'avg err':0, 'max':0}
-
   def updateAccuracyStats(self):
     # Update the stats
-    s = self.__accuracyStats(self.measurements[self.curLoc])
+    if self.acc.num > 0:
+      # update the average position
+      self.avgPos = self.acc.mean.copy()
+    s = self.acc.accuracyStats()
     self.InvokeEvent(self.stats1Changed, str(s))
 
     # if sequence over, store stats
@@ -88,23 +86,30 @@ class SinglePointMeasurement(vtk.vtkObject):
       logging.info(f'¤¤¤¤¤¤ Single Point Accuracy [{self.refOriName}] ({s["num"]}): avg err = {s["avg err"]:.2f}, '
         f'max = {s["max"]:.2f} ¤¤¤¤¤¤')
 
-  def __precisionStats(self, measurements):
-    if len(measurements) > 0:
-      # stdDist = RMS of deviations from mean
-      return {'num':len(measurements), 'span': Span(measurements), 'rms': stdDist(measurements)}
-    else:
-      return {'num':0, 'span':0, 'rms':0}
-
   def updatePrecisionStats(self):
-    # Update the stats
-    s = self.__precisionStats(self.measurements[self.curLoc])
+    # Update the stats (rms = RMS of deviations from mean, i.e. stdDist)
+    s = self.acc.precisionStats()
     self.InvokeEvent(self.stats2Changed, str(s))
 
     # if sequence over, store stats
     if self.acquiNum == self.acquiNumMax and len(self.measurements[self.curLoc]) > 0:
+      # error ellipsoid of the acquisitions, computed once per location
+      s['ellipsoid'] = self.__ellipsoid()
       if self.curLoc:
         self.precisionStats[self.curLoc] = s
-      logging.info(f'¤¤¤¤¤¤ Single Point Precision [{self.refOriName}] ({s["num"]}): span = {s["span"]:.2f}, rms = {s["rms"]:.2f} ¤¤¤¤¤¤')
+      logging.info(f'¤¤¤¤¤¤ Single Point Precision [{self.refOriName}] ({s["num"]}): span = {s["span"]:.2f}, rms = {s["rms"]:.2f}, '
+        f'ellipsoid std = {np.around(s["ellipsoid"]["std"], 3).tolist()} ¤¤¤¤¤¤')
+
+  # Principal axes of the scatter of the acquisitions at the current location
+  def __ellipsoid(self):
+    cov = self.acc.cov()
+    std, axes = covEigen(cov)
+    return {'std':std, 'axes':axes, 'cov':cov}
+
+  # Error ellipsoids of all locations, e.g. for export
+  def ellipsoids(self):
+    return {loc: s['ellipsoid'] for loc, s in self.precisionStats.items()
+      if s is not None and 'ellipsoid' in s}
 
 #
 # Rotation Measurement class
@@ -120,6 +125,8 @@ class RotationMeasurement(vtk.vtkObject):
     self.__names = ["Roll", "Pitch", "Yaw"]
     self.rotAxisName = self.__names[self.rotAxis]
     self.curLoc = None
+    # span of the measurements at the current location, updated on each sample
+    self.spanTracker = SpanTracker()
 
   # Reset all measurements and stats
   def fullReset(self):
@@ -135,10 +142,17 @@ class RotationMeasurement(vtk.vtkObject):
     if self.curLoc:
       self.measurements[self.curLoc] = np.empty((0,4), float)
       self.stats[self.curLoc] = None
+    self.spanTracker.reset()
     # base position for precision estimation, typically the averaged position
     # measured in the Single Point Measurement
     self.basePos = None
 
+  # Store a sample (angle and position) and return the updated span
+  def addSample(self, ang, pos):
+    self.measurements[self.curLoc] = np.append(self.measurements[self.curLoc],
+      [np.append(ang, pos)], axis = 0)
+    return self.spanTracker.push(pos)
+
   # Calculate stats on measurements
   def __stats(self, meas):
     if len(meas) > 0 and self.basePos.any():
@@ -147,7 +161,7 @@ class RotationMeasurement(vtk.vtkObject):
       # RMS of deviations from base position
       rms = rmsDist(meas[:,1:], self.basePos)
       return {"num":len(meas), "rangeMin":rg[0], "rangeMax":rg[1],
-        "span":Span(meas[:,1:]), "rms":rms}
+        "span":self.spanTracker.span, "rms":rms}
     else:
       return {"num":0, "rangeMin":0, "rangeMax":0, "span":0, "rms":0}
 
@@ -216,12 +230,13 @@ class DistMeasurement(vtk.vtkObject):
       return {'num':0, 'mean':0, 'min':0, 'max':0, 'rms':0}
         
   def updateDistStats(self):
-    # Compute errors
+    # Compute errors for all pairs of measured divots (in combinations order)
     errors = []
-    for kp in itertools.combinations(self.measurements[self.curLoc], 2):
-      gtDist = Dist(self.gtPts[kp[0]], self.gtPts[kp[1]])
-      ptrDist = Dist(self.measurements[self.curLoc][kp[0]], self.measurements[self.curLoc][kp[1]])
-      errors.append(abs(gtDist - ptrDist))
+    keys = list(self.measurements[self.curLoc])
+    if len(keys) > 1:
+      gtDists = pairwiseDist([self.gtPts[k] for k in keys])
+      ptrDists = pairwiseDist([self.measurements[self.curLoc][k] for k in keys])
+      errors = np.abs(gtDists - ptrDists)[np.triu_indices(len(keys), 1)]
     
     # Update the stats
     s = self.__stats(errors)
@@ -252,11 +267,12 @@ class DistMeasurement(vtk.vtkObject):
       ldmkTransfo.SetModeToRigidBody()  # not similarity
       ldmkTransfo.Update()
       transfoMat = ldmkTransfo.GetMatrix()
-      
-      for k in self.measurements[self.curLoc]:
-        p0 = np.append(self.measurements[self.curLoc][k], 1.0)  # adding 1.0 for homogeneous coords
-        p1 = transfoMat.MultiplyDoublePoint(p0) # outputs a tuple
-        errors.append(Dist(p1[0:3], self.gtPts[k]))
+      M = np.array([[transfoMat.GetElement(i,j) for j in range(4)] for i in range(3)])
+
+      # registration residuals of all measured divots at once
+      P = np.array([self.measurements[self.curLoc][k] for k in self.measurements[self.curLoc]])
+      G = np.array([self.gtPts[k] for k in self.measurements[self.curLoc]])
+      errors = distToRef(P.dot(M[:,:3].T) + M[:,3], G)
 
     # Update the stats
     s = self.__stats(errors)
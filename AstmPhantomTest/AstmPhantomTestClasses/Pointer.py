@@ -1,77 +1,74 @@
 import vtk
 import logging
 import slicer
-import numpy as np
-import qt
-import os
-import math
-from .Utils import PosQueue
+import time
+from .PointerCore import PointerCore
+from .Profiler import profiler, profiled
+from .TrackerStream import FrameAssembler
+
+# property reading and writing an attribute of the pointer core
+def _coreAttribute(name):
+  return property(lambda self: getattr(self.core, name),
+    lambda self, val: setattr(self.core, name, val))
+
+# installs the properties of the core attributes listed by the class
+def _installCoreAttributes(cls):
+  for name in cls.coreAttributes:
+    setattr(cls, name, _coreAttribute(name))
 
 #
 # Pointer class
 #
+# Slicer side of the pointer: forwards the frames of its transform nodes to the
+# pointer core (see PointerCore), relays the core events as vtk events and displays
+# the pointer model (tilt color, opacity while moving).
 
 class Pointer(vtk.vtkObject):
   """This is a custom class for the pointer
   """
+  # state of the core, also accessed as pointer attributes by the logic, widget and targets
+  coreAttributes = ('id', 'height', 'movingTol', 'motionMode', 'smoothing', 'tracking', 'moving',
+    'staticConstraint', 'acquiring', 'acquiDone', 'acquiMode', 'robustGate', 'numFrames', 'lookback',
+    'acquiDuration', 'monitorTilt', 'maxTilt', 'emitAngles', 'trkRollAxis', 'trkPitchAxis', 'trkYawAxis',
+    'ptrRollAxis', 'ptrPitchAxis', 'ptrYawAxis', 'tipOffset', 'pivotCalib', 'eventData',
+    'movedEvent', 'stoppedEvent', 'movingTolChanged', 'trackingStoppedEvent', 'trackingStartedEvent',
+    'staticFailEvent', 'acquiProgEvent', 'acquiDoneEvent', 'acquiDoneOutEvent', 'anglesChangedEvent')
+
   def __init__(self):
     super().__init__()
-    self.id = "XXXXX" # pointer id, typically its serial number
-    self.pq = PosQueue(20)  # queue to continuously store the last 20 pointer positions
+    self.core = PointerCore()
+    self.core.listeners.append(self.onCoreEvent)
     self.ptrRefTransfoNode = None
     self.ptrTransfoNode = None
-    self.model = None
+    self.model = None  # optional, no display without it
     self.obsId = None
-    # pointer moving, moved, stopped
-    self.moving = False
-    self.movingTol = 0.5
-    self.movedEvent = vtk.vtkCommand.UserEvent + 1
-    self.stoppedEvent = vtk.vtkCommand.UserEvent + 2
-    self.movingTolChanged = vtk.vtkCommand.UserEvent + 3
-    # pointer tracking status
-    self.tracking = False
-    self.trackingStoppedEvent = vtk.vtkCommand.UserEvent + 4
-    self.trackingStartedEvent = vtk.vtkCommand.UserEvent + 5
-    # static and acquisition status
-    self.staticConstraint = False
-    self.staticFailEvent = vtk.vtkCommand.UserEvent + 6
-    self.acquiring = False
-    self.acquiDone = False
-    self.acquiProgEvent = vtk.vtkCommand.UserEvent + 7
-    self.acquiDoneEvent = vtk.vtkCommand.UserEvent + 8
-    self.acquiDoneOutEvent = vtk.vtkCommand.UserEvent + 9
-    # accumulator and timer
-    self.acquiMode = 0  # 0: 1-frame, 1: mean, 2: median
-    self.coordAccumulator = np.array([])  # stores all incoming coordinates during acquisition
-    self.numFrames = 30  # number of successive frames considered in the acquisition of a single point
-    self.timer = qt.QTimer()
-    self.timerDuration = 500 # ms, by default 0.5 second
-    self.timer.setInterval(50)  # timer ticks every 50 ms
-    self.timer.connect('timeout()', self.staticTimerCallback)
-    self.ticks = 0
-    # tilt
-    self.monitorTilt = True
-    self.maxTilt = 60 # default value
-    # angles wrt to standard reference axes
-    self.emitAngles = False
-    self.anglesChangedEvent = vtk.vtkCommand.UserEvent + 11
-    # standard reference axes in tracker referential (default values)
-    self.trkRollAxis = [0,0,1]
-    self.trkPitchAxis = [-1,0,0]
-    self.trkYawAxis = [0,-1,0]
-    # standard reference axes in pointer referential (default values)
-    self.ptrRollAxis = [0,0,-1]
-    self.ptrPitchAxis = [-1,0,0]
-    self.ptrYawAxis = [0,1,0]
-    self.modelTransfoNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ptrModelTransfo')
-    # init matrices to identity
-    self.ptrRefMat = np.identity(4)
-    self.ptrMat = np.identity(4)
-    self.stdPtrMat = np.identity(4)
-    self.ptrRotMat = np.identity(4)
-    self.trkRotMat = np.identity(4)
-    # pointer height (in mm, important for pointer visibility near top of the working volume)
-    self.height = 0
+    self.frames = None  # frame assembler providing the transforms
+    # model display: the tilt color is quantized and the display node only modified
+    # when the color bucket or the opacity changes, at most maxDisplayRate times per second
+    self.colorBuckets = 32
+    self.colorBucket = None
+    self.opacity = None
+    self.maxDisplayRate = 0 # Hz, 0 for no limit
+    self.lastDisplayTime = 0
+    self.modelTransfoNode = None  # created with the model
+
+  # Relays the core events to the observers of the pointer
+  def onCoreEvent(self, event):
+    if event == self.movedEvent:
+      self.setOpacity(0.4)
+    elif event == self.stoppedEvent:
+      self.setOpacity(1.0)
+    self.InvokeEvent(event)
+
+  # Times the observers of the pointer events when profiling is enabled
+  def InvokeEvent(self, event, *args):
+    if not profiler.enabled:
+      return super().InvokeEvent(event, *args)
+    t0 = time.perf_counter()
+    try:
+      return super().InvokeEvent(event, *args)
+    finally:
+      profiler.record(f'Pointer.InvokeEvent({self.core.eventNames.get(event, event)})', time.perf_counter() - t0)
 
   def readModel(self, path):
     prevModelNode = slicer.mrmlScene.GetFirstNodeByName('PointerModel')
@@ -83,48 +80,46 @@ class Pointer(vtk.vtkObject):
       self.model = slicer.util.loadModel(path)
       self.model.SetName('PointerModel')
       self.model.GetDisplayNode().VisibilityOff()
+    if self.modelTransfoNode is None:
+      self.modelTransfoNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ptrModelTransfo')
+      self.alignModel()
 
   def setMovingTolerance(self, val):
     self.movingTol = val
     self.InvokeEvent(self.movingTolChanged, str(val))
 
-  def setTransfoNodes(self, ptrRefTransfoNode, ptrTransfoNode):
-    # apply transformation to the model according to rotation axes
-    self.model.SetAndObserveTransformNodeID(self.modelTransfoNode.GetID())
-    # apply the ptr from ref transform to the pointer model in post-multiply
+  def setTransfoNodes(self, ptrRefTransfoNode, ptrTransfoNode, frames = None):
+    if self.model:
+      # apply transformation to the model according to rotation axes
+      self.model.SetAndObserveTransformNodeID(self.modelTransfoNode.GetID())
+      # apply the ptr from ref transform to the pointer model in post-multiply
+      self.modelTransfoNode.SetAndObserveTransformNodeID(ptrRefTransfoNode.GetID())
     self.ptrRefTransfoNode = ptrRefTransfoNode
-    self.modelTransfoNode.SetAndObserveTransformNodeID(self.ptrRefTransfoNode.GetID())
-    # observe the ptrRef transform
-    self.ptrRefTransfoNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, \
-          self.onPtrRefTransformModified)
-
     self.ptrTransfoNode = ptrTransfoNode
-    # observe the ptr transform
-    self.ptrTransfoNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, \
-      self.onPtrTransformModified)
+
+    # both transforms are read once per tracker frame by a frame assembler, which
+    # can be shared with other consumers of the tracker stream, e.g. other pointers
+    if self.frames:
+      self.frames.RemoveObserver(self.obsId)
+    if frames is None:
+      frames = FrameAssembler()
+    frames.addNodes([ptrRefTransfoNode, ptrTransfoNode])
+    self.frames = frames
+    self.ptrRefIdx = frames.index(ptrRefTransfoNode)
+    self.ptrIdx = frames.index(ptrTransfoNode)
+    self.obsId = self.frames.AddObserver(self.frames.frameEvent, self.onFrame)
 
   def readPointerFile(self, path):
     """
-    Reads and parse the orientation of the pointer standard axes
+    Reads the pointer file (see PointerCore) and aligns the model with its axes
     """
-    logging.info('Read pointer file')
-    self.id = os.path.basename(path).split('.txt')[0] # retrieve filename only
-    # read the file content
-    file = open(path, 'r')
-    lines = file.readlines()
-    for l in lines:
-      q = np.fromstring(l.split('=')[1], dtype=float, sep=' ')
-      if l.startswith('MAXTILT'):
-        self.maxTilt = q[0]
-      if l.startswith('ROLL'):
-        self.ptrRollAxis = q.tolist()
-      if l.startswith('PITCH'):
-        self.ptrPitchAxis = q.tolist()
-      if l.startswith('YAW'):
-        self.ptrYawAxis = q.tolist()
-      if l.startswith('HEIGHT'):
-        self.height = q[0]
-    self.checkPtrAxes()
+    self.core.readPointerFile(path)
+    if self.modelTransfoNode:
+      self.alignModel()
+    return True
+
+  # Aligns the model with the yaw and roll axes of the pointer
+  def alignModel(self):
     # calculate the model transformation necessary to align with yaw and roll axes
     ptsFrom = vtk.vtkPoints()
     ptsFrom.InsertNextPoint([0,0,0]) # model origin
@@ -140,150 +135,77 @@ class Pointer(vtk.vtkObject):
     ldmkTransfo.SetModeToSimilarity()
     ldmkTransfo.Update()
     self.modelTransfoNode.SetMatrixTransformToParent(ldmkTransfo.GetMatrix())
-    return True
 
   def checkPtrAxes(self):
-    # make sure the standard referential frames provided for
-    # the pointer are orthonormal and direct
-    self.ptrRollAxis = self.ptrRollAxis/np.linalg.norm(self.ptrRollAxis)
-    self.ptrPitchAxis = np.cross(self.ptrYawAxis/np.linalg.norm(self.ptrYawAxis),
-      self.ptrRollAxis)
-    self.ptrYawAxis = np.cross(self.ptrRollAxis, self.ptrPitchAxis)
-    # build rotation matrix from axes: X = roll, Y = pitch, Z = yaw
-    self.ptrRotMat = np.array([self.ptrRollAxis, self.ptrPitchAxis, self.ptrYawAxis])
+    self.core.checkPtrAxes()
 
   def checkTrkAxes(self):
-    # make sure the standard referential frames provided for
-    # the tracker are orthonormal and direct
-    self.trkRollAxis = self.trkRollAxis/np.linalg.norm(self.trkRollAxis)
-    self.trkPitchAxis = np.cross(self.trkYawAxis/np.linalg.norm(self.trkYawAxis),
-      self.trkRollAxis)
-    self.trkYawAxis = np.cross(self.trkRollAxis, self.trkPitchAxis)
-    # build rotation matrix from axes: X = roll, Y = pitch, Z = yaw
-    self.trkRotMat = np.array([self.trkRollAxis, self.trkPitchAxis, self.trkYawAxis])
+    self.core.checkTrkAxes()
 
-  def __rotmat2euler(self, mat):
-    angRoll = math.atan2(mat[2,1], mat[2,2])
-    angPitch = math.atan2(-mat[2,0], math.sqrt(mat[2,1]**2 + mat[2,2]**2))
-    angYaw = math.atan2(mat[1,0], mat[0,0])
-    return [angRoll*180/math.pi, angPitch*180/math.pi, angYaw*180/math.pi]
+  def stdMats(self, ptrMats):
+    return self.core.stdMats(ptrMats)
 
-  # returns pointer euler angles in standard referential frame
   def angles(self):
-    return self.__rotmat2euler(self.stdPtrMat)
+    return self.core.angles()
 
-  # returns the unsigned tilt from roll axis in std ref frame
   def tilt(self):
-    return math.acos(self.stdPtrMat[0,0])*180/math.pi
+    return self.core.tilt()
+
+  # colors the model from red (prog = 0) to green (prog = 1)
+  def setTiltColor(self, prog):
+    bucket = round(min(max(prog, 0.0), 1.0)*(self.colorBuckets-1))
+    if bucket != self.colorBucket and self.model:
+      if self.maxDisplayRate > 0:
+        now = time.perf_counter()
+        if now - self.lastDisplayTime < 1.0/self.maxDisplayRate:
+          return # caught up on a following frame
+        self.lastDisplayTime = now
+      self.colorBucket = bucket
+      c = bucket/(self.colorBuckets-1)
+      self.model.GetDisplayNode().SetColor(1-c, c, 0)
+
+  def setOpacity(self, opacity):
+    if opacity != self.opacity and self.model:
+      self.opacity = opacity
+      self.model.GetDisplayNode().SetOpacity(opacity)
 
-  # returns the position from ptr from ref transform
   def pos(self):
-    return self.ptrRefMat[:-1,3]
+    return self.core.pos()
 
-  @vtk.calldata_type(vtk.VTK_STRING)
-  def onPtrTransformModified(self, caller, event=None, calldata=None):
-    if self.ptrTransfoNode.GetAttribute("TransformStatus") == "MISSING":
-      if self.tracking:
-        self.tracking = False
-        # logging.info('/!\ Tracking stopped')
-        self.InvokeEvent(self.trackingStoppedEvent)
-    elif self.ptrTransfoNode.GetAttribute("TransformStatus") == "OK":
-      if not self.tracking:
-        self.tracking = True
-        # logging.info(" => Tracking started")
-        self.InvokeEvent(self.trackingStartedEvent)
-      # update current matrices
-      self.ptrMat = slicer.util.arrayFromTransformMatrix(self.ptrTransfoNode)
-      self.stdPtrMat = self.trkRotMat.dot(self.ptrMat[:3,:3].dot(self.ptrRotMat.T))
-      # emit tilt value
-      if self.monitorTilt:
-        prog = (self.maxTilt-self.tilt())/self.maxTilt # normalize discrepancy from 0 deg tilt goal
-        self.model.GetDisplayNode().SetColor(1-prog, prog, 0) # color with respect to discrepancy
+  def filteredPos(self):
+    return self.core.filteredPos()
 
-  @vtk.calldata_type(vtk.VTK_STRING)
-  def onPtrRefTransformModified(self, caller, event=None, calldata=None):
-    if self.ptrTransfoNode.GetAttribute("TransformStatus") == "OK":
-      # update current matrix
-      self.ptrRefMat = slicer.util.arrayFromTransformMatrix(self.ptrRefTransfoNode)
-      # if angles are to be emitted, emit them alongside the current pointer position
-      if self.emitAngles:
-        self.InvokeEvent(self.anglesChangedEvent, str(self.angles()+self.pos().tolist()))
-      # retrieve pointer position
-      self.pq.push(self.pos())
-      # if moved by more than the moving tolerance from last position in queue
-      if self.pq.strideMean(10,10) > self.movingTol:
-        if not self.moving:
-          self.moving = True
-          self.InvokeEvent(self.movedEvent)
-          self.model.GetDisplayNode().SetOpacity(0.4)
-          if self.staticConstraint: # pointer needs to be static
-            if self.acquiDone: # acquisition done
-              self.acquiDone = False
-              self.staticConstraint = False
-              self.InvokeEvent(self.acquiDoneOutEvent)
-            else:
-              if self.acquiring:
-                self.acquiring = False
-                self.coordAccumulator = np.array([])
-                if self.acquiMode == 0 and self.timer.isActive():
-                  self.timer.stop()
-              self.InvokeEvent(self.staticFailEvent)
-      else:
-        if self.moving:
-          self.moving = False
-          self.model.GetDisplayNode().SetOpacity(1.0)
-          # emit event with pointer position attached to it as a string
-          self.InvokeEvent(self.stoppedEvent, str(self.pos().tolist()))
-        if self.acquiring:
-          if not self.coordAccumulator.any():
-            self.coordAccumulator = np.array([self.pos().tolist()])  # [[]] important for stacking
-          else:
-            self.coordAccumulator = np.append(self.coordAccumulator, [self.pos().tolist()], axis=0)
-          # if not 1-frame acquisition
-          if self.acquiMode != 0:
-            prog = min(np.size(self.coordAccumulator,0)/(self.numFrames + self.pq.maxsz), 1.0)  # estimate progression (btw 0.0 and 1.0)
-            self.InvokeEvent(self.acquiProgEvent, str(prog))
-            # Testing if accumulator is full i.e. its size equals desired number of frames
-            # once the queue is removed
-            if np.size(self.coordAccumulator,0) - self.pq.maxsz == self.numFrames:
-              self.acquiring = False
-              self.acquiDone = True
-              if self.acquiMode == 1:  # mean
-                p = np.mean(self.coordAccumulator[:-self.pq.maxsz], axis=0)
-              if self.acquiMode == 2:  # median
-                p = np.median(self.coordAccumulator[:-self.pq.maxsz], axis=0)
-              self.coordAccumulator = np.array([])
-              self.InvokeEvent(self.acquiDoneEvent, str(p.tolist()))
+  def innovation(self):
+    return self.core.innovation()
+
+  def setMotionMode(self, mode):
+    self.core.setMotionMode(mode)
+
+  def setSmoothing(self, enabled):
+    self.core.setSmoothing(enabled)
+
+  def startPivotCalibration(self):
+    self.core.startPivotCalibration()
+
+  def finishPivotCalibration(self):
+    return self.core.finishPivotCalibration()
+
+  # Forwards the tracker frame to the core, then colors the model with the tilt
+  @profiled('Pointer.onFrame')
+  def onFrame(self, caller, event=None):
+    ptrUpdated = self.frames.updated[self.ptrIdx]
+    self.core.onFrame(self.frames.time, self.frames.status[self.ptrIdx],
+      self.frames.mats[self.ptrIdx] if ptrUpdated else None,
+      self.frames.mats[self.ptrRefIdx] if self.frames.updated[self.ptrRefIdx] else None)
+    if ptrUpdated and self.core.status == "OK" and self.core.monitorTilt:
+      self.setTiltColor(self.core.tiltProg()) # color with respect to discrepancy
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def startAcquiring(self, caller, event = None, calldata = None):
-    if not self.moving:
-      self.staticConstraint = True
-      self.acquiring = True
-      self.coordAccumulator = np.array([])
-      if self.acquiMode == 0:
-        self.timer.interval = min(self.timerDuration, self.timer.interval)
-        self.maxTicks = int(self.timerDuration / self.timer.interval)
-        self.ticks = 0
-        self.timer.start()
-        logging.info(f'   Timer started for {self.maxTicks} ticks')
+    self.core.startAcquiring()
+
+  # Cancels an ongoing acquisition
+  def stopAcquiring(self):
+    self.core.stopAcquiring()
 
-  def staticTimerCallback(self):
-    if not self.moving and self.timer.isActive():
-      self.ticks += 1
-      prog = min(self.ticks / self.maxTicks, 1.0)  # estimate progression (btw 0.0 and 1.0)
-      self.InvokeEvent(self.acquiProgEvent, str(prog))
-      if prog >= 1:
-        self.timer.stop()
-        self.acquiring = False
-        if np.size(self.coordAccumulator,0) == 0:
-          msgBox = qt.QMessageBox()
-          msgBox.setText("No sample taken during timer duration for point acquisition. Restart module and try again with increased duration.")
-          msgBoxsgBox.setIcon(qt.QMessageBox().Warning)
-          msgBoxsgBox.setStandardButtons(qt.QMessageBox().Ok)
-          msgBoxsgBox.exec()
-        else:
-          p = self.coordAccumulator[int(np.size(self.coordAccumulator,0)/2)]  # get middle coordinates
-          self.coordAccumulator = np.array([])
-          self.acquiDone = True
-          self.InvokeEvent(self.acquiDoneEvent, str(p.tolist()))
+_installCoreAttributes(Pointer)
@@ -0,0 +1,395 @@
+import logging
+import numpy as np
+import os
+from .Utils import PosQueue, AlphaBetaFilter, rotmat2euler, tiltAngle, robustMean, pivotCalibration, RMS
+from .Profiler import profiled
+
+#
+# Pointer core class
+#
+# Moving/stopped/acquiring state machine of a pointer, without Slicer nor VTK: it is
+# fed with tracker frames, i.e. a timestamp (s, tracker time), the status of the pointer
+# transform and the pointer from tracker and pointer from reference 4x4 matrices, and
+# notifies its listeners of the pointer events. The Pointer class forwards the frames
+# of the transform nodes to it and applies the visuals, while the core alone can
+# replay or simulate recorded frames headless, e.g. in worker processes.
+# Event ids are those of the Pointer vtk events (from vtkCommand.UserEvent).
+
+class PointerCore():
+  userEvent = 1000  # vtk.vtkCommand.UserEvent
+  # record attached to the pointer events (stopped, anglesChanged, acquiProg, acquiDone)
+  # instead of a calldata string: observers read caller.eventData, which is overwritten
+  # by the next event, so values to be kept must be copied
+  eventDtype = np.dtype([('t', 'f8'), ('pos', 'f8', 3), ('angles', 'f8', 3), ('prog', 'f8'), ('rejected', 'i4'), ('innov', 'f8')])
+
+  def __init__(self):
+    self.id = "XXXXX" # pointer id, typically its serial number
+    self.pq = PosQueue(20, 10, 10)  # queue to continuously store the last 20 pointer positions
+    self.listeners = []  # callables notified of the events, with the event id
+    # current frame
+    self.frameNum = 0
+    self.time = 0.0  # s, tracker time
+    self.status = None  # "TransformStatus" of the pointer transform
+    # pointer moving, moved, stopped
+    self.moving = False
+    self.movingTol = 0.5
+    # optional smoothing of the positions used for motion detection and target proximity
+    # (measurements always use the raw positions, queued in rawPq for lookback)
+    self.smoothing = False
+    self.posFilter = AlphaBetaFilter()
+    self.rawPq = PosQueue(self.pq.maxsz)
+    self.lastPosTime = None
+    # 0: mean stride, 1: median stride (more robust to tracker jitter, cheap with the
+    # incremental window medians), 2: statistical, see setMotionMode
+    self.setMotionMode(1)
+    # statistical motion detection (mode 2, independent of movingTol): moving if the drift
+    # between the queue windows is significant wrt the jitter measured in the queue
+    # Hotelling T² quantile for a 0.1% false motion rate per static frame: 3 dims and ~15
+    # effective degrees of freedom of the jitter covariance, estimated from only 19
+    # correlated successive differences (fitted by simulation of white jitter)
+    self.movingT2 = 35.3
+    self.jitterFloor = 0.05  # mm, lower bound of the jitter std dev
+    self.movedEvent = self.userEvent + 1
+    self.stoppedEvent = self.userEvent + 2
+    self.movingTolChanged = self.userEvent + 3
+    # pointer tracking status
+    self.tracking = False
+    self.trackingStoppedEvent = self.userEvent + 4
+    self.trackingStartedEvent = self.userEvent + 5
+    # static and acquisition status
+    self.staticConstraint = False
+    self.staticFailEvent = self.userEvent + 6
+    self.acquiring = False
+    self.acquiDone = False
+    self.acquiProgEvent = self.userEvent + 7
+    self.acquiDoneEvent = self.userEvent + 8
+    self.acquiDoneOutEvent = self.userEvent + 9
+    # accumulator
+    self.acquiMode = 0  # 0: 1-frame, 1: mean, 2: median, 3: robust (MAD-gated) mean
+    self.robustGate = 3.0  # number of robust std devs beyond which frames are rejected (mode 3)
+    self.robustFloor = 0.05  # mm, minimum gate, so that noise-free frames are not rejected
+    self.numFrames = 30  # number of successive frames considered in the acquisition of a single point
+    # preallocated storage of all incoming coordinates during acquisition, filled up to accuNum
+    self.coordAccumulator = np.zeros((self.numFrames + self.pq.maxsz, 3))
+    self.accuNum = 0
+    # lookback (off by default): mean/median acquisitions start with the newest positions
+    # of the motion queue, i.e. its head window compared by the stop test, instead of
+    # waiting for new frames. The rest of the queue may still hold the end of the approach,
+    # and even the head window does if the pointer slowly settles in the divot
+    self.lookback = False
+    self.lookbackFrame = -1  # frame whose position is already in the accumulator
+    self.acquiDuration = 500 # ms of tracker time for 1-frame acquisition, by default 0.5 second
+    self.acquiStart = 0.0 # tracker time of the acquisition start
+    # tilt
+    self.monitorTilt = True
+    self.maxTilt = 60 # default value
+    # angles wrt to standard reference axes
+    self.emitAngles = False
+    self.anglesChangedEvent = self.userEvent + 11
+    # standard reference axes in tracker referential (default values)
+    self.trkRollAxis = [0,0,1]
+    self.trkPitchAxis = [-1,0,0]
+    self.trkYawAxis = [0,-1,0]
+    # standard reference axes in pointer referential (default values)
+    self.ptrRollAxis = [0,0,-1]
+    self.ptrPitchAxis = [-1,0,0]
+    self.ptrYawAxis = [0,1,0]
+    # init matrices to identity
+    self.ptrRefMat = np.identity(4)
+    self.ptrMat = np.identity(4)
+    self.stdPtrMat = np.identity(4)
+    self.ptrRotMat = np.identity(4)
+    self.trkRotMat = np.identity(4)
+    self.checkPtrAxes()
+    self.checkTrkAxes()
+    # pointer height (in mm, important for pointer visibility near top of the working volume)
+    self.height = 0
+    # tip offset in pointer coordinates (from the pointer file TIP or a pivot calibration),
+    # applied to the tracked position
+    self.tipOffset = np.zeros(3)
+    self.tipPos = np.zeros(3)
+    # pivot calibration: recorded ptr from ref matrices, filled up to pivotNum
+    self.pivotRecording = False
+    self.pivotMats = np.zeros((1024,4,4))
+    self.pivotNum = 0
+    self.pivotMinFrames = 100
+    self.pivotCalib = None  # result of the last pivot calibration
+    # event record: time, position (current one, or acquired point for acquiDone),
+    # euler angles, acquisition progress, number of frames rejected (mode 3) and innovation
+    # of the position filter
+    self.eventData = np.zeros((), dtype=self.eventDtype)
+    # event names, e.g. for profiling of the event fan-out
+    self.eventNames = {v:k for k, v in vars(self).items() if k.endswith('Event') or k == 'movingTolChanged'}
+
+  def emit(self, event):
+    for listener in self.listeners:
+      listener(event)
+
+  def readPointerFile(self, path):
+    """
+    Reads and parse the orientation of the pointer standard axes
+    """
+    logging.info('Read pointer file')
+    self.id = os.path.basename(path).split('.txt')[0] # retrieve filename only
+    # read the file content
+    file = open(path, 'r')
+    lines = file.readlines()
+    for l in lines:
+      q = np.fromstring(l.split('=')[1], dtype=float, sep=' ')
+      if l.startswith('MAXTILT'):
+        self.maxTilt = q[0]
+      if l.startswith('ROLL'):
+        self.ptrRollAxis = q.tolist()
+      if l.startswith('PITCH'):
+        self.ptrPitchAxis = q.tolist()
+      if l.startswith('YAW'):
+        self.ptrYawAxis = q.tolist()
+      if l.startswith('HEIGHT'):
+        self.height = q[0]
+      if l.startswith('TIP'):
+        self.tipOffset = q[:3]
+    self.checkPtrAxes()
+    return True
+
+  def checkPtrAxes(self):
+    # make sure the standard referential frames provided for
+    # the pointer are orthonormal and direct
+    self.ptrRollAxis = self.ptrRollAxis/np.linalg.norm(self.ptrRollAxis)
+    self.ptrPitchAxis = np.cross(self.ptrYawAxis/np.linalg.norm(self.ptrYawAxis),
+      self.ptrRollAxis)
+    self.ptrYawAxis = np.cross(self.ptrRollAxis, self.ptrPitchAxis)
+    # build rotation matrix from axes: X = roll, Y = pitch, Z = yaw
+    self.ptrRotMat = np.array([self.ptrRollAxis, self.ptrPitchAxis, self.ptrYawAxis])
+
+  def checkTrkAxes(self):
+    # make sure the standard referential frames provided for
+    # the tracker are orthonormal and direct
+    self.trkRollAxis = self.trkRollAxis/np.linalg.norm(self.trkRollAxis)
+    self.trkPitchAxis = np.cross(self.trkYawAxis/np.linalg.norm(self.trkYawAxis),
+      self.trkRollAxis)
+    self.trkYawAxis = np.cross(self.trkRollAxis, self.trkPitchAxis)
+    # build rotation matrix from axes: X = roll, Y = pitch, Z = yaw
+    self.trkRotMat = np.array([self.trkRollAxis, self.trkPitchAxis, self.trkYawAxis])
+
+  # returns the rotations of pointer matrices (...,4,4) in the standard referential
+  # frame (...,3,3), e.g. to re-analyze recorded poses
+  def stdMats(self, ptrMats):
+    return np.matmul(self.trkRotMat, np.matmul(np.asarray(ptrMats)[...,:3,:3], self.ptrRotMat.T))
+
+  # returns pointer euler angles in standard referential frame
+  def angles(self):
+    return rotmat2euler(self.stdPtrMat).tolist()
+
+  # returns the unsigned tilt from roll axis in std ref frame
+  def tilt(self):
+    return float(tiltAngle(self.stdPtrMat))
+
+  # returns the tilt progression, from 0 (maxTilt) to 1 (0 deg tilt goal)
+  def tiltProg(self):
+    return (self.maxTilt-self.tilt())/self.maxTilt # normalize discrepancy from 0 deg tilt goal
+
+  # returns the tip position from ptr from ref transform
+  def pos(self):
+    return self.tipPos
+
+  # returns the position used for motion detection, filtered if smoothing
+  def filteredPos(self):
+    return self.posFilter.x if self.smoothing else self.tipPos
+
+  # returns the magnitude of the last innovation of the position filter
+  def innovation(self):
+    return float(self.posFilter.innovation)
+
+  # Sets the motion detection mode, maintaining incrementally the queue stats it needs
+  def setMotionMode(self, mode):
+    self.motionMode = mode
+    self.pq.setStats(medians = mode == 1, diffs = mode == 2)
+
+  def setSmoothing(self, enabled):
+    self.smoothing = enabled
+    self.posFilter.reset()
+    self.rawPq.reset()
+    self.lastPosTime = None
+
+  def startPivotCalibration(self):
+    logging.info('Pivot calibration: recording started')
+    self.pivotNum = 0
+    self.pivotRecording = True
+
+  # Solves the pivot calibration over the recorded frames and, if successful, applies the
+  # tip offset. Returns the result, or None
+  def finishPivotCalibration(self):
+    self.pivotRecording = False
+    if self.pivotNum < self.pivotMinFrames:
+      logging.warning(f'Pivot calibration: not enough frames ({self.pivotNum} < {self.pivotMinFrames})')
+      return None
+    res = pivotCalibration(self.pivotMats[:self.pivotNum])
+    if res is None:
+      logging.warning('Pivot calibration: not enough rotation, pivot the pointer more widely')
+      return None
+    tip, pivot, residuals = res
+    self.pivotCalib = {'pointer': self.id, 'frames': self.pivotNum, 'tip': tip, 'pivot': pivot,
+      'rms': RMS(residuals), 'max': float(np.max(residuals))}
+    self.tipOffset = tip
+    logging.info(f'Pivot calibration ({self.pivotNum} frames): tip = {np.around(tip, 3).tolist()}, '
+      f'rms = {self.pivotCalib["rms"]:.3f}, max = {self.pivotCalib["max"]:.3f}')
+    return self.pivotCalib
+
+  # Empties the accumulator, reallocating it if the number of frames has increased
+  def resetAccumulator(self):
+    self.accuNum = 0
+    self.lookbackFrame = -1
+    if len(self.coordAccumulator) < self.numFrames + self.pq.maxsz:
+      self.coordAccumulator = np.zeros((self.numFrames + self.pq.maxsz, 3))
+
+  def accumulate(self, pos):
+    if self.accuNum == len(self.coordAccumulator):  # 1-frame acquisition only, grow by doubling
+      self.coordAccumulator = np.concatenate((self.coordAccumulator, np.zeros_like(self.coordAccumulator)))
+    self.coordAccumulator[self.accuNum] = pos
+    self.accuNum += 1
+
+  # returns a view on the accumulated coordinates
+  def accumulated(self):
+    return self.coordAccumulator[:self.accuNum]
+
+  # Single update per tracker frame: t is the frame timestamp (s), ptrMat and ptrRefMat
+  # the pointer from tracker and pointer from reference matrices, None if not updated in
+  # the frame, and status the "TransformStatus" of the pointer transform (with ptrMat).
+  # Pointer orientation first as position processing depends on it
+  @profiled('PointerCore.onFrame')
+  def onFrame(self, t, status, ptrMat = None, ptrRefMat = None):
+    self.frameNum += 1
+    self.time = t
+    self.eventData['t'] = t
+    if ptrMat is not None:
+      self.status = status
+      self.onPtrTransformModified(ptrMat)
+    if ptrRefMat is not None:
+      self.onPtrRefTransformModified(ptrRefMat)
+
+  @profiled('PointerCore.onPtrTransformModified')
+  def onPtrTransformModified(self, ptrMat):
+    if self.status == "MISSING":
+      if self.tracking:
+        self.tracking = False
+        # logging.info('/!\ Tracking stopped')
+        self.emit(self.trackingStoppedEvent)
+    elif self.status == "OK":
+      if not self.tracking:
+        self.tracking = True
+        self.posFilter.reset()  # restart the filter from the first new position
+        self.lastPosTime = None
+        # logging.info(" => Tracking started")
+        self.emit(self.trackingStartedEvent)
+      # update current matrices
+      np.copyto(self.ptrMat, ptrMat)
+      self.stdPtrMat = self.stdMats(self.ptrMat)
+
+  @profiled('PointerCore.onPtrRefTransformModified')
+  def onPtrRefTransformModified(self, ptrRefMat):
+    if self.status == "OK":
+      # update current matrix
+      np.copyto(self.ptrRefMat, ptrRefMat)
+      np.dot(self.ptrRefMat[:3,:3], self.tipOffset, out=self.tipPos)
+      self.tipPos += self.ptrRefMat[:3,3]
+      if self.pivotRecording:
+        if self.pivotNum == len(self.pivotMats):
+          self.pivotMats = np.concatenate((self.pivotMats, np.zeros_like(self.pivotMats)))
+        self.pivotMats[self.pivotNum] = self.ptrRefMat
+        self.pivotNum += 1
+      # if angles are to be emitted, emit them alongside the current pointer position
+      if self.emitAngles:
+        self.eventData['angles'] = rotmat2euler(self.stdPtrMat)
+        self.eventData['pos'] = self.pos()
+        self.emit(self.anglesChangedEvent)
+      # retrieve pointer position, filtered if smoothing
+      if self.smoothing:
+        dt = self.time - self.lastPosTime if self.lastPosTime is not None else 0.0
+        self.lastPosTime = self.time
+        self.posFilter.update(self.pos(), dt)
+        self.eventData['innov'] = self.posFilter.innovation
+        self.rawPq.push(self.pos())
+      self.pq.push(self.filteredPos())
+      # if moved by more than the moving tolerance from last position in queue
+      if self.motionMode == 2:
+        moved = self.pq.strideT2(10,10, self.jitterFloor) > self.movingT2
+      elif self.motionMode == 1:
+        moved = self.pq.strideMed(10,10) > self.movingTol
+      else:
+        moved = self.pq.strideMean(10,10) > self.movingTol
+      if moved:
+        if not self.moving:
+          self.moving = True
+          self.emit(self.movedEvent)
+          if self.staticConstraint: # pointer needs to be static
+            if self.acquiDone: # acquisition done
+              self.acquiDone = False
+              self.staticConstraint = False
+              self.emit(self.acquiDoneOutEvent)
+            else:
+              if self.acquiring:
+                self.acquiring = False
+                self.resetAccumulator()
+              self.emit(self.staticFailEvent)
+      else:
+        if self.moving:
+          self.moving = False
+          # emit event with pointer position attached to it
+          self.eventData['pos'] = self.filteredPos()
+          self.emit(self.stoppedEvent)
+        if self.acquiring:
+          if self.frameNum != self.lookbackFrame:
+            self.accumulate(self.pos())
+          if self.acquiMode == 0:
+            # progression in tracker time
+            prog = min((self.time - self.acquiStart)*1000/self.acquiDuration, 1.0) if self.acquiDuration > 0 else 1.0
+            self.eventData['prog'] = prog
+            self.emit(self.acquiProgEvent)
+            if prog >= 1:
+              self.acquiring = False
+              self.acquiDone = True
+              self.eventData['pos'] = self.coordAccumulator[self.accuNum//2]  # middle coordinates
+              self.resetAccumulator()
+              self.emit(self.acquiDoneEvent)
+          else:
+            prog = min(self.accuNum/(self.numFrames + self.pq.maxsz), 1.0)  # estimate progression (btw 0.0 and 1.0)
+            self.eventData['prog'] = prog
+            self.emit(self.acquiProgEvent)
+            # Testing if accumulator is full i.e. its size equals desired number of frames
+            # once the queue is removed
+            if self.accuNum - self.pq.maxsz == self.numFrames:
+              self.acquiring = False
+              self.acquiDone = True
+              if self.acquiMode == 1:  # mean
+                p = np.mean(self.accumulated()[:-self.pq.maxsz], axis=0)
+              if self.acquiMode == 2:  # median
+                p = np.median(self.accumulated()[:-self.pq.maxsz], axis=0)
+              if self.acquiMode == 3:  # robust mean
+                samples = self.accumulated()[:-self.pq.maxsz]
+                p, rejected = robustMean(samples, np.median(samples, axis=0), self.robustGate, self.robustFloor)
+                self.eventData['rejected'] = rejected
+                logging.info(f'   Robust acquisition: {rejected}/{self.numFrames} frames rejected')
+              self.resetAccumulator()
+              self.eventData['pos'] = p
+              self.emit(self.acquiDoneEvent)
+
+  def startAcquiring(self):
+    if not self.moving:
+      self.staticConstraint = True
+      self.acquiring = True
+      self.resetAccumulator()
+      # acquisition window starts with the current frame
+      self.acquiStart = self.time
+      queue = self.rawPq if self.smoothing else self.pq  # raw positions
+      if self.lookback and self.acquiMode != 0 and queue.size() == queue.maxsz:
+        for p in queue.head(self.pq.w1):
+          self.accumulate(p)
+        self.lookbackFrame = self.frameNum  # current position is the newest in the queue
+      if self.acquiMode == 0:
+        logging.info(f'   Acquisition started for {self.acquiDuration}ms')
+
+  # Cancels an ongoing acquisition
+  def stopAcquiring(self):
+    if self.acquiring:
+      self.acquiring = False
+      self.resetAccumulator()
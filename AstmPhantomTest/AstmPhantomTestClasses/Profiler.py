@@ -0,0 +1,93 @@
+import time
+import math
+import json
+import functools
+
+#
+# Profiler class
+#
+# Low-overhead instrumentation of the hot paths (tracker frame handlers and the
+# events they fire). For each named section it keeps a call count, the min, mean
+# and max latencies and a histogram with log-spaced bins, from which percentiles
+# are estimated. Recording is a no-op unless the profiler is enabled, which can be
+# switched at runtime.
+
+class Profiler():
+  def __init__(self, enabled = False):
+    self.enabled = enabled
+    self.binsPerDecade = 20  # i.e. bins ~12% wide
+    self.minLatency = 1e-7  # s, lower edge of the first bin
+    self.numBins = 7*self.binsPerDecade  # up to 1 s, longer calls fall in the last bin
+    self.reset()
+
+  def reset(self):
+    self.sections = {}
+
+  def record(self, name, dt):
+    s = self.sections.get(name)
+    if s is None:
+      s = self.sections[name] = {'count':0, 'total':0.0, 'min':math.inf, 'max':0.0, 'hist':[0]*self.numBins}
+    s['count'] += 1
+    s['total'] += dt
+    if dt < s['min']:
+      s['min'] = dt
+    if dt > s['max']:
+      s['max'] = dt
+    b = int(math.log10(max(dt, self.minLatency)/self.minLatency)*self.binsPerDecade)
+    s['hist'][min(b, self.numBins-1)] += 1
+
+  # Upper edge of the histogram bin holding the q-quantile (0 < q <= 1), in s
+  def percentile(self, name, q):
+    s = self.sections[name]
+    rank = math.ceil(q*s['count'])
+    cum = 0
+    for b, n in enumerate(s['hist']):
+      cum += n
+      if cum >= rank:
+        return min(self.minLatency*10**((b+1)/self.binsPerDecade), s['max'])
+    return s['max']
+
+  # Per-section stats, latencies in ms
+  def summary(self):
+    return {name: {'count': s['count'],
+      'total': s['total']*1e3,
+      'min': s['min']*1e3,
+      'mean': s['total']/s['count']*1e3,
+      'p99': self.percentile(name, 0.99)*1e3,
+      'max': s['max']*1e3} for name, s in self.sections.items() if s['count'] > 0}
+
+  # Edges of the histogram bins, in s: bin b spans [edges[b], edges[b+1]), except
+  # the first and last bins which also hold the shorter and longer latencies
+  def binEdges(self):
+    return [self.minLatency*10**(b/self.binsPerDecade) for b in range(self.numBins+1)]
+
+  # Writes the summary and the latency histograms, i.e. the counts per bin of each
+  # section, with the bin edges (in ms)
+  def dump(self, path):
+    sections = self.summary()
+    for name, s in sections.items():
+      s['hist'] = self.sections[name]['hist']
+    with open(path, 'w') as f:
+      json.dump({'unit': 'ms', 'binEdges': [e*1e3 for e in self.binEdges()], 'sections': sections}, f, indent=2)
+
+# shared instance, used by the profiled decorator
+profiler = Profiler()
+
+#
+# Decorator recording the latency of a function in the shared profiler
+# (when used on vtk observers, apply it below @vtk.calldata_type)
+#
+
+def profiled(name):
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if not profiler.enabled:
+        return func(*args, **kwargs)
+      t0 = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        profiler.record(name, time.perf_counter() - t0)
+    return wrapper
+  return decorator
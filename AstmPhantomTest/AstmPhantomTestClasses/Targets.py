@@ -69,7 +69,10 @@ class Targets(vtk.vtkObject):
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onTargetFocus(self, caller, event, calldata):
-    p = ast.literal_eval(calldata)  # parsing string into [pos_x, pos_y, pos_z]
+    if calldata is None:  # pointer event record
+      p = caller.eventData['pos'].tolist()
+    else:
+      p = ast.literal_eval(calldata)  # parsing string into [pos_x, pos_y, pos_z]
     if self.proxiDetect:
       for k in self.targets:
         dist = Dist(p, self.targets[k].pos)
@@ -90,9 +93,12 @@ class Targets(vtk.vtkObject):
 
   @vtk.calldata_type(vtk.VTK_STRING)
   def onTargetIn(self, caller, event, calldata):
-    cd = ast.literal_eval(calldata)
-    if not isinstance(cd, list):
-      cd = [cd]
+    if calldata is None:  # pointer event record
+      cd = [float(caller.eventData['prog'])]
+    else:
+      cd = ast.literal_eval(calldata)
+      if not isinstance(cd, list):
+        cd = [cd]
     if self.lblHit:
       prog = max(min(cd[0], 1.0), 0)  # restrict progress between 0 and 1
       self.targets[self.lblHit].onTargetIn(prog)
@@ -110,7 +116,10 @@ class Targets(vtk.vtkObject):
   def onTargetDone(self, caller, event, calldata):
     if self.lblHit:
       self.targets[self.lblHit].onTargetDone()
-      p = ast.literal_eval(calldata)  # parsing string into [px, py, pz]
+      if calldata is None:  # pointer event record
+        p = caller.eventData['pos'].tolist()
+      else:
+        p = ast.literal_eval(calldata)  # parsing string into [px, py, pz]
       logging.info(f'   Target [{self.lblHit}] == Done == with {np.around(p,2).tolist()}')
       cd = [self.lblHit] + p
       self.InvokeEvent(self.targetDoneEvent, str(cd))
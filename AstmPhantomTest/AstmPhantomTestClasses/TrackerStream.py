@@ -0,0 +1,222 @@
+import vtk
+import slicer
+import numpy as np
+import time
+import math
+import bisect  # for the running median of the intervals
+import collections
+
+#
+# Stream monitor class
+#
+# Statistics of the arrivals of one transform node: inter-arrival times (mean, jitter
+# i.e. std dev, max), effective rate, and gaps, i.e. intervals longer than gapFactor
+# nominal periods, with the estimated number of frames dropped in them. The nominal
+# period is the running median of the last periodWindow intervals within gapFactor of
+# it: neither gaps nor bursts of queued messages (e.g. after a stall of the UI, with
+# local clock timestamps) feed it. If the intervals remain out of that band, on the
+# same side, for at least periodWindow intervals and resyncTime seconds, the rate has
+# changed and the period is re-estimated from them. The frames of a burst right after
+# a gap were delayed, not dropped, and are deducted from the frames dropped in the gap.
+
+class StreamMonitor():
+  def __init__(self, name = ""):
+    self.name = name
+    self.gapFactor = 1.5
+    self.periodWindow = 31
+    self.resyncTime = 0.5  # s
+    self.reset()
+
+  def reset(self):
+    self.num = 0
+    self.first = None
+    self.last = None
+    self.dtNum = 0
+    self.dtMean = 0.0
+    self.dtM2 = 0.0
+    self.dtMax = 0.0
+    self.period = None
+    self.intervals = collections.deque()  # intervals of the running median, by arrival
+    self.sortedIntervals = []
+    self.outOfBand = []  # successive intervals out of the period band, on the same side
+    self.outOfBandTime = 0.0
+    self.delayed = 0  # frames of the last gap that may still arrive in a burst
+    self.gaps = 0
+    self.dropped = 0
+    self.markNum = 0
+    self.markTime = None
+
+  def push(self, t):
+    if self.last is None:
+      self.first = t
+    else:
+      dt = t - self.last
+      if dt <= 0:
+        return  # same message notified twice
+      if self.period is not None and dt > self.gapFactor*self.period:
+        self.gaps += 1
+        self.delayed = max(round(dt/self.period) - 1, 0)
+        self.dropped += self.delayed
+        self.pushOutOfBand(dt, True)
+      elif self.period is not None and dt*self.gapFactor < self.period:
+        if self.delayed > 0:
+          self.delayed -= 1
+          self.dropped -= 1
+        self.pushOutOfBand(dt, False)  # burst of queued messages, or faster rate
+      else:
+        self.delayed = 0
+        self.outOfBand = []
+        self.outOfBandTime = 0.0
+        self.pushInterval(dt)
+      # Welford update of the inter-arrival time stats
+      self.dtNum += 1
+      delta = dt - self.dtMean
+      self.dtMean += delta/self.dtNum
+      self.dtM2 += delta*(dt - self.dtMean)
+      self.dtMax = max(self.dtMax, dt)
+    self.last = t
+    self.num += 1
+
+  # Adds an interval to the running median of the period
+  def pushInterval(self, dt):
+    self.intervals.append(dt)
+    bisect.insort(self.sortedIntervals, dt)
+    if len(self.intervals) > self.periodWindow:
+      del self.sortedIntervals[bisect.bisect_left(self.sortedIntervals, self.intervals.popleft())]
+    n = len(self.sortedIntervals)
+    self.period = self.sortedIntervals[n//2] if n % 2 else (self.sortedIntervals[n//2-1] + self.sortedIntervals[n//2])/2
+
+  def pushOutOfBand(self, dt, long):
+    if self.outOfBand and (self.outOfBand[-1] > self.period) != long:
+      self.outOfBand = []  # other side, e.g. burst after a gap
+      self.outOfBandTime = 0.0
+    self.outOfBand.append(dt)
+    self.outOfBandTime += dt
+    if len(self.outOfBand) >= self.periodWindow and self.outOfBandTime >= self.resyncTime:
+      # sustained rate change
+      self.intervals.clear()
+      self.sortedIntervals = []
+      for d in self.outOfBand[-self.periodWindow:]:
+        self.pushInterval(d)
+      self.outOfBand = []
+      self.outOfBandTime = 0.0
+
+  # Average rate (Hz) over the whole stream
+  def rate(self):
+    return self.dtNum/(self.last - self.first) if self.dtNum > 0 else 0.0
+
+  # Rate (Hz) since the previous call, e.g. for a periodic display
+  def recentRate(self):
+    n = self.num - self.markNum
+    rate = n/(self.last - self.markTime) if n > 0 and self.markTime is not None else 0.0
+    self.markNum = self.num
+    self.markTime = self.last
+    return rate
+
+  def jitter(self):
+    return math.sqrt(self.dtM2/self.dtNum) if self.dtNum > 0 else 0.0
+
+  # Stream stats, times in ms
+  def stats(self):
+    return {"frames": self.num,
+      "rate": self.rate(),
+      "mean dt": self.dtMean*1e3,
+      "jitter": self.jitter()*1e3,
+      "max dt": self.dtMax*1e3,
+      "gaps": self.gaps,
+      "dropped": self.dropped}
+
+#
+# Frame assembler class
+#
+# Observes the transform nodes streamed by the tracker (e.g. PointerToPhantom,
+# PointerToTracker, PhantomToTracker) and gathers the ones of a same tracker frame:
+# each matrix is read once, with its status, into a shared (K,4,4) buffer and a
+# single frameEvent is fired when all nodes have been updated. If a node is updated
+# again before the others (e.g. one tool is not streamed), the incomplete frame is
+# fired first, so that no update is lost.
+# Frames are timestamped in tracker time (in s) when the nodes carry the timestamp of
+# the tracker message in timestampAttribute, with the local clock otherwise. The
+# arrivals of each node are monitored (see StreamMonitor).
+
+class FrameAssembler(vtk.vtkObject):
+  def __init__(self):
+    super().__init__()
+    self.frameEvent = vtk.vtkCommand.UserEvent + 1
+    self.vmat = vtk.vtkMatrix4x4()  # reused to read the matrices
+    self.timestampAttribute = "Timestamp"
+    self.nodes = []
+    self.obsIds = []
+    self.setNodes([])
+
+  def setNodes(self, nodes):
+    for node, obsId in zip(self.nodes, self.obsIds):
+      node.RemoveObserver(obsId)
+    self.nodes = list(nodes)
+    self.mats = np.tile(np.identity(4), (len(self.nodes), 1, 1))  # latest matrices
+    self.status = [None] * len(self.nodes)  # latest "TransformStatus" attributes
+    self.updated = np.zeros(len(self.nodes), dtype=bool)  # nodes updated in the current frame
+    self.times = np.zeros(len(self.nodes))  # latest timestamps
+    self.frameNum = 0
+    self.time = 0.0  # timestamp of the current frame
+    self.monitors = [StreamMonitor(node.GetName()) for node in self.nodes]
+    self.obsIds = [node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+      lambda caller, event, i=i: self.onNodeModified(i)) for i, node in enumerate(self.nodes)]
+
+  # Adds nodes to the observed ones (if not already), keeping the state of the others,
+  # e.g. for another tool
+  def addNodes(self, nodes):
+    new = [node for node in nodes if node not in self.nodes]
+    if len(new) == 0:
+      return
+    i0 = len(self.nodes)
+    self.nodes += new
+    self.mats = np.concatenate((self.mats, np.tile(np.identity(4), (len(new), 1, 1))))
+    self.status += [None] * len(new)
+    self.updated = np.concatenate((self.updated, np.zeros(len(new), dtype=bool)))
+    self.times = np.concatenate((self.times, np.zeros(len(new))))
+    self.monitors += [StreamMonitor(node.GetName()) for node in new]
+    self.obsIds += [node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+      lambda caller, event, i=i: self.onNodeModified(i)) for i, node in enumerate(new, i0)]
+
+  def index(self, node):
+    return self.nodes.index(node)
+
+  def monitor(self, name):
+    for m in self.monitors:
+      if m.name == name:
+        return m
+    return None
+
+  def streamStats(self):
+    return {m.name: m.stats() for m in self.monitors}
+
+  def onNodeModified(self, i):
+    if self.updated[i]:
+      self.flush()
+    node = self.nodes[i]
+    self.status[i] = node.GetAttribute("TransformStatus")
+    self.times[i] = self.timestamp(node)
+    self.monitors[i].push(float(self.times[i]))
+    node.GetMatrixTransformToParent(self.vmat)
+    self.vmat.DeepCopy(self.mats[i].ravel(), self.vmat)
+    self.updated[i] = True
+    if self.updated.all():
+      self.flush()
+
+  def timestamp(self, node):
+    ts = node.GetAttribute(self.timestampAttribute) if self.timestampAttribute else None
+    if ts:
+      try:
+        return float(ts)
+      except ValueError:
+        pass
+    return time.perf_counter()
+
+  # Fires the current frame, observers read mats, status, updated and time
+  def flush(self):
+    if self.updated.any():
+      self.frameNum += 1
+      self.time = float(np.max(self.times[self.updated]))
+      self.InvokeEvent(self.frameEvent)
+      self.updated[:] = False
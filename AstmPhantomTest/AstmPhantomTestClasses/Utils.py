@@ -1,107 +1,329 @@
 import numpy as np
-import vtk, json
-import itertools  # for combinations
+import json
+import base64  # for binary serialization of nd-arrays
+import bisect  # for sorted insertion in order statistics
+try:
+  from scipy.spatial import ConvexHull  # for span calculation on large sample sets
+except ImportError:
+  ConvexHull = None
+
+#
+# Order statistics class
+#
+# Keeps the coordinates of a set of 3D positions sorted per axis, so that samples
+# can be added or removed in O(log n) search + memmove and the median read in O(1).
+
+class OrderStats():
+  def __init__(self):
+    self.reset()
+
+  def size(self):
+    return len(self.axes[0])
+
+  def reset(self):
+    self.axes = [[], [], []]
+
+  def add(self, pos):
+    for lst, v in zip(self.axes, pos.tolist()):
+      bisect.insort(lst, v)
+
+  def remove(self, pos):
+    for lst, v in zip(self.axes, pos.tolist()):
+      del lst[bisect.bisect_left(lst, v)]
+
+  def median(self):
+    n = len(self.axes[0])
+    if n % 2:
+      return np.array([lst[n//2] for lst in self.axes])
+    else:
+      return np.array([(lst[n//2-1] + lst[n//2])/2 for lst in self.axes])
 
 #
 # Position queue class
 #
+# Fixed-capacity circular buffer of 3D positions. Every sample is written twice,
+# at slot i and i+maxsz, so that any window of the last maxsz samples is a
+# contiguous slice of the buffer, i.e. a zero-copy view, even across wrap-around.
 
 class PosQueue():
-  def __init__(self, size):
+  def __init__(self, size, w1 = 0, w2 = 0, medians = False, diffs = False):
     self.maxsz = size
+    self.buf = np.zeros((2*self.maxsz, 3), dtype='float64')
+    self.medians = medians
+    self.diffs = diffs
+    self.setWindows(w1, w2)
+
+  # Sets the sizes of the head (w1 newest) and tail (w2 oldest) windows whose sums
+  # (and medians if enabled) are maintained incrementally, so that strideMean(w1, w2)
+  # costs O(1) and strideMed(w1, w2) O(log w) per frame. No window stats for w1 = w2 = 0
+  def setWindows(self, w1, w2):
+    if (w1 != 0 or w2 != 0) and (w1 <= 0 or w2 <=0 or w1+w2 > self.maxsz):
+      w1 = 1
+      w2 = 1
+    self.w1 = w1
+    self.w2 = w2
     self.reset()
 
+  # Enables the incremental window medians (for strideMed) and sums of successive
+  # differences (for strideT2). Both are off by default as they add to the cost of
+  # every push; without them, strideMed and strideT2 compute from the queued positions
+  def setStats(self, medians = False, diffs = False):
+    self.medians = medians
+    self.diffs = diffs
+    self.headMed.reset()
+    self.tailMed.reset()
+    if self.medians and self.w1:
+      for p in self.head(min(self.w1, self.count)):
+        self.headMed.add(p)
+      for p in self.tail(min(self.w2, self.count)):
+        self.tailMed.add(p)
+    self.resync()
+
   def size(self):
-    return len(self.queue)
+    return self.count
 
   def reset(self):
-    self.queue = []
-    self.sum = np.array([0,0,0], dtype='float64')
+    self.idx = 0  # slot of the next write, in [0, maxsz)
+    self.count = 0
+    self.headSum = np.array([0,0,0], dtype='float64')
+    self.tailSum = np.array([0,0,0], dtype='float64')
+    self.headMed = OrderStats()
+    self.tailMed = OrderStats()
+    # sums of the differences between successive queued positions and of their outer products
+    self.diffSum = np.zeros(3)
+    self.diffOuter = np.zeros((3,3))
 
   def push(self, pos):
-    self.queue.insert(0, pos)
-    self.sum += pos
-    if len(self.queue) > self.maxsz:
-      self.sum -= self.queue.pop()
+    start = self.idx + self.maxsz - self.count  # slot of the oldest sample
+    medians = self.medians and self.w1
+    # update the window stats with the samples leaving them, before they get overwritten
+    if self.w1 and self.count >= self.w1:
+      self.headSum -= self.buf[start + self.count - self.w1]
+      if medians:
+        self.headMed.remove(self.buf[start + self.count - self.w1])
+    if self.diffs and self.count > 0:
+      d = pos - self.buf[self.idx + self.maxsz - 1]  # difference with the newest sample
+      self.diffSum += d
+      self.diffOuter += np.outer(d, d)
+    if self.count == self.maxsz:
+      if self.diffs:
+        d = self.buf[start + 1] - self.buf[start]  # oldest difference, leaving the queue
+        self.diffSum -= d
+        self.diffOuter -= np.outer(d, d)
+      if self.w2:
+        self.tailSum -= self.buf[start]  # oldest sample, about to be overwritten
+        self.tailSum += self.buf[start + self.w2]  # sample entering the tail window
+        if medians:
+          self.tailMed.remove(self.buf[start])
+          self.tailMed.add(self.buf[start + self.w2])
+    else:
+      self.count += 1
+    self.buf[self.idx::self.maxsz] = pos  # slots idx and idx+maxsz
+    if self.w1:
+      self.headSum += self.buf[self.idx]
+      if medians:
+        self.headMed.add(self.buf[self.idx])
+    if self.count <= self.w2:
+      # queue still filling up the tail window
+      self.tailSum += self.buf[self.idx]
+      if medians:
+        self.tailMed.add(self.buf[self.idx])
+    self.idx = (self.idx + 1) % self.maxsz
+    # once per turn of the ring, recompute the sums to stop rounding errors from drifting
+    if self.idx == 0 and (self.w1 or self.diffs):
+      self.resync()
+
+  def resync(self):
+    self.headSum = np.sum(self.head(min(self.w1, self.count)), axis=0)
+    self.tailSum = np.sum(self.tail(min(self.w2, self.count)), axis=0)
+    if self.diffs:
+      D = np.diff(self.window(), axis=0)
+      self.diffSum = np.sum(D, axis=0)
+      self.diffOuter = D.T.dot(D)
+
+  # returns a view on the queued positions, from oldest to newest
+  def window(self):
+    return self.buf[self.idx + self.maxsz - self.count : self.idx + self.maxsz]
+
+  # returns a view on the w newest positions (from oldest to newest)
+  def head(self, w):
+    return self.buf[self.idx + self.maxsz - w : self.idx + self.maxsz]
+
+  # returns a view on the w oldest positions (from oldest to newest)
+  def tail(self, w):
+    start = self.idx + self.maxsz - self.count
+    return self.buf[start : start + w]
 
   def strideMed(self, w1, w2):
-    if len(self.queue) < self.maxsz:
+    if self.count < self.maxsz:
       return float('inf')
     if (w1 <= 0 or w2 <=0 or w1+w2 > self.maxsz):
       w1 = 1
       w2 = 1
-    firstPos = np.median(self.queue[:w1], axis=0)
-    lastPos = np.median(self.queue[-w2:], axis=0)
+    if self.medians and w1 == self.w1 and w2 == self.w2:
+      # use the incrementally maintained window medians
+      return np.linalg.norm(self.headMed.median() - self.tailMed.median())
+    firstPos = np.median(self.head(w1), axis=0)
+    lastPos = np.median(self.tail(w2), axis=0)
     return np.linalg.norm(firstPos - lastPos) # distance between first and last positions in queue
 
   def strideMean(self, w1, w2):
-    if len(self.queue) < self.maxsz:
+    if self.count < self.maxsz:
       return float('inf')
     if (w1 <= 0 or w2 <=0 or w1+w2 > self.maxsz):
       w1 = 1
       w2 = 1
-    firstPos = np.mean(self.queue[:w1], axis=0)
-    lastPos = np.mean(self.queue[-w2:], axis=0)
+    if w1 == self.w1 and w2 == self.w2:
+      # use the incrementally maintained window sums
+      return np.linalg.norm(self.headSum/w1 - self.tailSum/w2)
+    firstPos = np.mean(self.head(w1), axis=0)
+    lastPos = np.mean(self.tail(w2), axis=0)
     return np.linalg.norm(firstPos - lastPos) # distance between first and last positions in queue
 
+  # Covariance of the differences between successive queued positions. For a static
+  # pointer, i.e. white jitter, it is twice the jitter covariance; a constant velocity
+  # does not contribute to it
+  def diffCov(self):
+    if not self.diffs:
+      return np.cov(np.diff(self.window(), axis=0).T, bias=True)
+    n = self.count - 1
+    m = self.diffSum/n
+    return self.diffOuter/n - np.outer(m, m)
+
+  # Hotelling-like T² statistic of the drift between the means of the w1 newest and
+  # w2 oldest positions, relative to the jitter measured in the queue (regularized by
+  # an isotropic jitter floor, in mm). As the jitter covariance is estimated from the
+  # few queued differences, it is not chi-squared distributed if the pointer is static
+  # but, approximately, a Hotelling T² (3 dims, ~15 effective degrees of freedom for a
+  # 20-sample queue) whose quantiles are much larger
+  def strideT2(self, w1, w2, floor = 0.05):
+    if self.count < self.maxsz:
+      return float('inf')
+    if (w1 <= 0 or w2 <=0 or w1+w2 > self.maxsz):
+      w1 = 1
+      w2 = 1
+    if w1 == self.w1 and w2 == self.w2:
+      drift = self.headSum/w1 - self.tailSum/w2
+    else:
+      drift = np.mean(self.head(w1), axis=0) - np.mean(self.tail(w2), axis=0)
+    cov = (self.diffCov()/2 + floor**2*np.identity(3)) * (1/w1 + 1/w2)
+    return float(drift.dot(np.linalg.solve(cov, drift)))
+
   def stride(self):
-    if len(self.queue) < self.maxsz:
+    if self.count < self.maxsz:
       return float('inf')
     else:
-      return np.linalg.norm(self.queue[0] - self.queue[-1]) # distance between first and last positions in queue
-  
+      # distance between first and last positions in queue
+      return np.linalg.norm(self.buf[self.idx + self.maxsz - 1] - self.buf[self.idx])
+
   def avg(self):
-    return self.sum/len(self.queue)
+    return np.mean(self.window(), axis=0)
+
+#
+# Alpha-beta filter class
+#
+# Constant-velocity tracking filter of 3D positions, vectorized over any leading
+# dimensions (e.g. (K,3) for K tools tracked in the same frames). Each update predicts
+# the position from the estimated velocity, then corrects position and velocity with
+# the gains alpha and beta by the innovation, i.e. measured minus predicted position.
+
+class AlphaBetaFilter():
+  def __init__(self, alpha = 0.5, beta = 0.1, shape = (3,)):
+    self.alpha = alpha
+    self.beta = beta
+    self.shape = shape
+    self.reset()
+
+  def reset(self):
+    self.x = np.zeros(self.shape)  # filtered positions
+    self.v = np.zeros(self.shape)  # estimated velocities (per s)
+    self.r = np.zeros(self.shape)  # innovations
+    self.innovation = np.zeros(self.shape[:-1])  # innovation magnitudes
+    self.dt = 0.0
+    self.initialized = False
+
+  # Filters the measured positions z, dt seconds after the previous ones
+  def update(self, z, dt):
+    if not self.initialized:
+      self.x[...] = z
+      self.initialized = True
+      return self.x
+    if dt <= 0:
+      dt = self.dt  # same timestamp, assume the last period
+    self.dt = dt
+    self.x += self.v * dt  # prediction
+    np.subtract(z, self.x, out=self.r)
+    self.x += self.alpha * self.r
+    if dt > 0:
+      self.v += (self.beta / dt) * self.r
+    self.innovation[...] = np.linalg.norm(self.r, axis=-1)
+    return self.x
+
+#
+# Numpy array from a vtkMatrix4x4 (as in slicer.util.arrayFromVTKMatrix)
+#
+
+def arrayFromVtkMatrix(vmatrix):
+  narray = np.eye(4)
+  vmatrix.DeepCopy(narray.ravel(), vmatrix)
+  return narray
 
 #
 # Reimplementation of vtkRenderer::ResetCameraScreenSpace
 # (because it's not available in Slicer yet)
+#
+# All the corners are projected at once with the composite projection matrix of
+# the camera. The resulting camera is cached per renderer: as long as the visible
+# prop bounds, the viewport size and the camera orientation are the same as in
+# the last call, the cached camera is restored without any recomputation.
+
+_camResetCache = {}
+
+def _camKey(renderer, bds):
+  cam = renderer.GetActiveCamera()
+  return (tuple(np.round(bds, 6)), tuple(renderer.GetRenderWindow().GetSize()),
+    tuple(renderer.GetViewport()), tuple(np.round(cam.GetDirectionOfProjection(), 6)),
+    tuple(np.round(cam.GetViewUp(), 6)), cam.GetParallelProjection(), round(cam.GetViewAngle(), 6))
+
+def _boxCorners(bmin, bmax):
+  # the 8 corners of a box, in homogeneous coordinates
+  return np.array([[x, y, z, 1.0] for x in (bmin[0], bmax[0])
+    for y in (bmin[1], bmax[1]) for z in (bmin[2], bmax[2])])
 
 def ResetCameraScreenSpace(renderer):
-  # Classic camera reset to ensure all props are visible
+  cam = renderer.GetActiveCamera()
   bds = renderer.ComputeVisiblePropBounds()
+  key = _camKey(renderer, bds)
+  cached = _camResetCache.get(renderer)
+  if cached and key in (cached['inKey'], cached['outKey']):
+    cam.SetFocalPoint(cached['focalPoint'])
+    cam.SetPosition(cached['position'])
+    cam.SetViewUp(cached['viewUp'])
+    cam.SetViewAngle(cached['viewAngle'])
+    cam.SetParallelScale(cached['parallelScale'])
+    cam.SetClippingRange(cached['clippingRange'])
+    return
+
+  # Classic camera reset to ensure all props are visible
   renderer.ResetCamera(bds)
 
   # Expand bounds (as in vtkRenderer::ExpandBounds, also not in Slicer yet)
-  pt = [[bds[0],bds[2],bds[5],1.0], [bds[1],bds[2],bds[5],1.0], \
-        [bds[1],bds[2],bds[4],1.0], [bds[0],bds[2],bds[4],1.0], \
-        [bds[0],bds[3],bds[5],1.0], [bds[1],bds[3],bds[5],1.0], \
-        [bds[1],bds[3],bds[4],1.0], [bds[0],bds[3],bds[4],1.0]]
-  cam = renderer.GetActiveCamera()
-  camMat = cam.GetModelTransformMatrix()
-  for i in range(0,8):
-    pt[i] = camMat.MultiplyPoint(pt[i])
-  bmin = list(pt[0]).copy()
-  bmax = list(pt[0]).copy()
-  for i in range(0,8):
-    for j in range(0,3):
-      bmin[j] = min(bmin[j], pt[i][j])
-      bmax[j] = max(bmax[j], pt[i][j])
-  bds = [bmin[0], bmax[0], bmin[1], bmax[1], bmin[2], bmax[2]]
-
-  # Compute the screen space bounding box
-  xmin = vtk.VTK_DOUBLE_MAX
-  ymin = vtk.VTK_DOUBLE_MAX
-  xmax = vtk.VTK_DOUBLE_MIN
-  ymax = vtk.VTK_DOUBLE_MIN
-  for i in range(0,2):
-    for j in range(0,2):
-      for k in range(0,2):
-        currentPoint = [bds[i], bds[j+2], bds[k+4], 1.0]
-        renderer.SetWorldPoint(currentPoint)
-        renderer.WorldToDisplay()
-        currentPointDisplay = renderer.GetDisplayPoint()
-        xmin = min(currentPointDisplay[0], xmin)
-        xmax = max(currentPointDisplay[0], xmax)
-        ymin = min(currentPointDisplay[1], ymin)
-        ymax = max(currentPointDisplay[1], ymax)
-
-  # Project the focal point in screen space
-  fp = list(cam.GetFocalPoint())
-  fp.append(1.0)
-  renderer.SetWorldPoint(fp)
-  renderer.WorldToDisplay()
-  fpDisplay = renderer.GetDisplayPoint()
+  pt = _boxCorners(bds[0::2], bds[1::2]).dot(arrayFromVtkMatrix(cam.GetModelTransformMatrix()).T)
+  bmin = np.min(pt[:,:3], axis=0)
+  bmax = np.max(pt[:,:3], axis=0)
+
+  # Compute the screen space bounding box and project the focal point in screen space,
+  # i.e. world -> view (as in vtkRenderer::WorldToView) -> display (vtkViewport::ViewToDisplay)
+  pts = np.vstack((_boxCorners(bmin, bmax), list(cam.GetFocalPoint()) + [1.0]))
+  proj = arrayFromVtkMatrix(cam.GetCompositeProjectionTransformMatrix(renderer.GetTiledAspectRatio(), 0, 1))
+  view = pts.dot(proj.T)
+  view = view[:,:2] / view[:,3:]
+  winSize = np.array(renderer.GetRenderWindow().GetSize(), dtype=float)
+  vp = renderer.GetViewport()
+  disp = (view + 1.0) * winSize * np.array([vp[2]-vp[0], vp[3]-vp[1]]) / 2.0 + winSize * np.array(vp[0:2])
+  xmin, ymin = np.min(disp[:8], axis=0)
+  xmax, ymax = np.max(disp[:8], axis=0)
+  fpDisplay = disp[8]
 
   # The focal point must be at the center of the box
   # So construct a box with fpDisplay at the center
@@ -120,16 +342,22 @@ def ResetCameraScreenSpace(renderer):
   ymin += yMinOffset
   ymax += yMaxOffset
   # Now the focal point is at the center of the box
-  box = vtk.vtkRecti(int(xmin), int(ymin), int(xmax - xmin), int(ymax - ymin))
+  boxWidth = int(xmax - xmin)
+  boxHeight = int(ymax - ymin)
   # We let a 5% offset around the zoomed data
   size = renderer.GetSize()
-  zf1 = size[0] / float(box.GetWidth())
-  zf2 = size[1] / float(box.GetHeight())
+  zf1 = size[0] / float(boxWidth)
+  zf2 = size[1] / float(boxHeight)
   zoomFactor = min(zf1, zf2)
   # OffsetRatio will let a free space between the zoomed data
   # And the edges of the window
   cam.Zoom(zoomFactor*0.95)
 
+  _camResetCache[renderer] = {'inKey': key, 'outKey': _camKey(renderer, bds),
+    'focalPoint': cam.GetFocalPoint(), 'position': cam.GetPosition(), 'viewUp': cam.GetViewUp(),
+    'viewAngle': cam.GetViewAngle(), 'parallelScale': cam.GetParallelScale(),
+    'clippingRange': cam.GetClippingRange()}
+
 #
 # Class NumpyEncoder:
 # which makes it possible to serialize a nd-array in nested dictionaries
@@ -140,6 +368,30 @@ class NumpyEncoder(json.JSONEncoder):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
+#
+# Class NumpyBinaryEncoder:
+# same as NumpyEncoder, but large numerical nd-arrays are written as base64 blocks
+# of their raw bytes with dtype and shape headers, which is much faster and more
+# compact than nested lists. Read back with json.load(..., object_hook=numpyBinaryDecoder)
+
+class NumpyBinaryEncoder(json.JSONEncoder):
+    minSize = 16  # arrays with fewer elements remain human-readable lists
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            if obj.size >= self.minSize and obj.dtype.kind in 'biuf':
+                arr = np.ascontiguousarray(obj)
+                return {'__ndarray__': base64.b64encode(arr.tobytes()).decode('ascii'),
+                        'dtype': arr.dtype.str, 'shape': arr.shape}
+            return obj.tolist()
+        return json.JSONEncoder.default(self, obj)
+
+def numpyBinaryDecoder(dct):
+    if '__ndarray__' in dct:
+        buf = base64.b64decode(dct['__ndarray__'])
+        return np.frombuffer(buf, dtype=np.dtype(dct['dtype'])).reshape(dct['shape'])
+    return dct
+
 
 #
 # Distance calculation
@@ -156,29 +408,119 @@ def RMS(samples):
   S = np.array(samples)
   return np.sqrt(np.mean(np.array(S)**2))
 
+#
+# Batched distance kernels
+# operating on (N,3) arrays in a single broadcast, with an optional preallocated
+# output buffer of shape (N,) (resp. (N,M) for pairwiseDist) for the distances
+
+# distances of each sample to a reference point (or to its paired point if ref is (N,3))
+def distToRef(samples, ref, out = None):
+  D = np.asarray(samples, dtype=float) - np.asarray(ref, dtype=float)
+  return np.sqrt(np.einsum('ij,ij->i', D, D), out=out)
+
+# RMS of the distances of the samples to a reference point
+def rmsToRef(samples, ref, out = None):
+  d = distToRef(samples, ref, out)
+  return np.sqrt(np.dot(d, d)/len(d))
+
+# distances between all samples of A and all samples of B (or A itself)
+def pairwiseDist(A, B = None, out = None):
+  A = np.asarray(A, dtype=float)
+  B = A if B is None else np.asarray(B, dtype=float)
+  D = A[:, None, :] - B[None, :, :]
+  return np.sqrt(np.einsum('ijk,ijk->ij', D, D), out=out)
+
 #
 # RMS of 3D coordinates from a reference
 # based on distance
 
 def rmsDist(samples, ref):
-  S = np.array(samples)
-  R = np.array(ref)
-  devs = [Dist(s, R) for s in S]
-  return np.sqrt(np.mean(np.array(devs)**2))
+  return rmsToRef(samples, ref)
 
 #
 # Standard deviation of 3D coordinates
 # based on distance
 #
 
-def stdDist(coords):
-  S = np.array(coords)
+def stdDist(coords, out = None):
+  S = np.asarray(coords, dtype=float)
   if S.ndim > 1:
-    avg = np.mean(S, axis=0)
+    return rmsToRef(S, np.mean(S, axis=0), out)
   else:
-    avg = np.mean(S)
-  devs = [Dist(s, avg) for s in S]
-  return np.sqrt(np.mean(np.array(devs)**2))
+    return np.sqrt(np.mean((S - np.mean(S))**2))
+
+#
+# Euler angles (roll, pitch, yaw in degrees, i.e. Z-Y-X convention) of rotation
+# matrices, batched over any leading dimensions: (N,3,3) -> (N,3)
+
+def rotmat2euler(mats):
+  mats = np.asarray(mats)
+  angles = np.empty(mats.shape[:-2] + (3,))
+  np.arctan2(mats[...,2,1], mats[...,2,2], out=angles[...,0])
+  np.arctan2(-mats[...,2,0], np.hypot(mats[...,2,1], mats[...,2,2]), out=angles[...,1])
+  np.arctan2(mats[...,1,0], mats[...,0,0], out=angles[...,2])
+  return np.degrees(angles, out=angles)
+
+#
+# Unsigned tilt (in degrees) from the X axis of rotation matrices, batched: (N,3,3) -> (N,)
+# (clipped, as rounding can bring the cosine slightly beyond 1)
+
+def tiltAngle(mats):
+  return np.degrees(np.arccos(np.clip(np.asarray(mats)[...,0,0], -1.0, 1.0)))
+
+#
+# MAD-gated mean of 3D samples (N,3) around their (per-axis) median: samples deviating
+# from it by more than k robust standard deviations (1.4826*MAD, at least floor) on
+# any axis are rejected. Returns the mean of the others and the number rejected
+
+def robustMean(samples, med, k = 3.0, floor = 0.05):
+  dev = np.abs(samples - med)
+  gate = np.maximum(k*1.4826*np.median(dev, axis=0), floor)
+  keep = np.all(dev <= gate, axis=1)
+  return np.mean(samples[keep], axis=0), int(len(samples) - np.count_nonzero(keep))
+
+#
+# Pivot calibration: from N poses (N,4,4) of a tool pivoting about a fixed point, solves
+# R_i.tip + t_i = pivot for the tip (in tool coordinates) and the pivot point (in the
+# reference coordinates) in a single least-squares over all frames. Returns the tip, the
+# pivot and the residual distance of each frame, or None if the poses do not span
+# enough rotations, i.e. if the condition number of the system exceeds maxCond (about
+# 7 for a +/-30 deg cone of poses, 20 for +/-10 deg, thousands when pivoting about a
+# single axis, which leaves the tip unknown along it).
+
+def pivotCalibration(mats, maxCond = 25):
+  mats = np.asarray(mats)
+  n = len(mats)
+  A = np.empty((n, 3, 6))
+  A[:, :, :3] = mats[:, :3, :3]
+  A[:, :, 3:] = -np.identity(3)
+  x, _, rank, sv = np.linalg.lstsq(A.reshape(3*n, 6), -mats[:, :3, 3].reshape(3*n), rcond=None)
+  if rank < 6 or sv[0] > maxCond*sv[-1]:
+    return None
+  tip, pivot = x[:3], x[3:]
+  return tip, pivot, distToRef(mats[:, :3, :3].dot(tip) + mats[:, :3, 3], pivot)
+
+#
+# Principal axes of 3D covariances
+# batched over any leading dimensions, e.g. (L,3,3) for L locations. Returns the
+# standard deviations along the principal axes (L,3), in decreasing order, and the
+# corresponding unit axes as rows (L,3,3)
+
+def covEigen(covs):
+  w, v = np.linalg.eigh(covs)  # ascending eigenvalues, eigenvectors as columns
+  return np.sqrt(np.clip(w[..., ::-1], 0, None)), np.swapaxes(v[..., ::-1], -1, -2)
+
+#
+# Convex hull vertices
+# (scipy is optional: without it, or for degenerate e.g. coplanar sets, None is returned)
+
+def hullVertices(samples):
+  if ConvexHull is None or len(samples) < 5:
+    return None
+  try:
+    return ConvexHull(samples).vertices
+  except Exception:  # qhull fails on flat or duplicated point sets
+    return None
 
 #
 # Span calculation
@@ -186,7 +528,134 @@ def stdDist(coords):
 
 def Span(samples):
   # Compute largest distance between two samples
+  S = np.array(samples, dtype=float)
+  if len(S) < 2:
+    return 0.0
+  # the two farthest samples are necessarily vertices of the convex hull
+  if len(S) > 32:
+    idx = hullVertices(S)
+    if idx is not None:
+      S = S[idx]
+  # squared distances of each sample to all others, by blocks of rows to bound memory
+  n = len(S)
+  rowMax = np.empty(n)
+  for i in range(0, n, 256):
+    d2 = np.sum((S[i:i+256, None, :] - S[None, :, :])**2, axis=2)
+    rowMax[i:i+256] = np.max(d2, axis=1)
+  # re-evaluate the few candidate pairs with Dist so that the result is exactly
+  # the one of the pairwise loop (the tolerance covers summation order differences)
+  thresh = np.max(rowMax)*(1 - 1e-9)
   span = 0.0
-  for pair in itertools.combinations(np.array(samples),2):
-    span = max(Dist(pair[0], pair[1]), span)
+  for i in np.flatnonzero(rowMax >= thresh):
+    d2 = np.sum((S - S[i])**2, axis=1)
+    for j in np.flatnonzero(d2 >= thresh):
+      span = max(Dist(S[i], S[j]), span)
   return span
+
+#
+# Span tracker class
+#
+# Maintains the span (largest distance between two samples) as samples come in.
+# The farthest sample from a new one is always a vertex of the convex hull of the
+# previous samples, so only a candidate set made of the hull vertices plus the
+# samples pushed since the last hull reduction is searched: O(h) per sample.
+
+class SpanTracker():
+  def __init__(self):
+    self.cand = np.empty((64,3))  # candidate extreme samples
+    self.dist = np.empty(64)  # scratch buffer for the distances to the candidates
+    self.reset()
+
+  def reset(self):
+    self.span = 0.0
+    self.ncand = 0
+    self.nhull = 0  # number of candidates after the last hull reduction
+
+  def push(self, pos):
+    pos = np.asarray(pos, dtype=float)
+    if self.ncand > 0:
+      C = self.cand[:self.ncand]
+      d = distToRef(C, pos, self.dist[:self.ncand])
+      # re-evaluate the farthest candidate(s) with Dist, as in Span
+      for i in np.flatnonzero(d >= np.max(d)*(1 - 1e-9)):
+        self.span = max(float(Dist(C[i], pos)), self.span)
+    if self.ncand == len(self.cand):
+      self.cand = np.concatenate((self.cand, np.empty_like(self.cand)))  # double capacity
+      self.dist = np.empty(len(self.cand))
+    self.cand[self.ncand] = pos
+    self.ncand += 1
+    # prune the candidates down to the hull vertices once they have doubled
+    if self.ncand > max(2*self.nhull, 64):
+      idx = hullVertices(self.cand[:self.ncand])
+      if idx is not None:
+        self.cand[:len(idx)] = self.cand[idx]
+        self.ncand = len(idx)
+      self.nhull = self.ncand
+    return self.span
+
+#
+# Point statistics accumulator class
+#
+# Updates the mean and covariance of incoming 3D points with Welford's numerically
+# stable recurrence, as well as the max distance to a reference point, in O(1) per
+# sample. Snapshots have the same shape as the single point accuracy/precision stats.
+
+class PointStatsAccumulator():
+  def __init__(self, ref = None):
+    self.ref = None
+    self.pts = np.empty((32,3))  # samples are kept for re-referencing
+    self.spanTracker = SpanTracker()
+    self.reset()
+    if ref is not None:
+      self.setRef(ref)
+
+  def reset(self):
+    self.num = 0
+    self.mean = np.zeros(3)
+    self.M2 = np.zeros((3,3))  # sum of products of deviations from the mean
+    self.maxDist = 0.0
+    self.spanTracker.reset()
+
+  # sets the reference point and updates the max distance to it
+  def setRef(self, ref):
+    self.ref = np.array(ref, dtype=float)
+    if self.num > 0:
+      self.maxDist = float(np.max(distToRef(self.points(), self.ref)))
+
+  def push(self, pos):
+    pos = np.asarray(pos, dtype=float)
+    if self.num == len(self.pts):
+      self.pts = np.concatenate((self.pts, np.empty_like(self.pts)))  # double capacity
+    self.pts[self.num] = pos
+    self.num += 1
+    delta = pos - self.mean
+    self.mean += delta/self.num
+    self.M2 += np.outer(delta, pos - self.mean)
+    if self.ref is not None:
+      self.maxDist = max(self.maxDist, float(Dist(pos, self.ref)))
+    self.spanTracker.push(pos)
+
+  # returns a view on the accumulated samples
+  def points(self):
+    return self.pts[:self.num]
+
+  # population covariance of the samples
+  def cov(self):
+    return (self.M2 + self.M2.T)/(2*self.num)
+
+  # RMS of the distances to the mean (i.e. stdDist)
+  def rms(self):
+    return float(np.sqrt(max(np.trace(self.M2), 0.0)/self.num))
+
+  def accuracyStats(self):
+    if self.num > 0:
+      # /!\ the length of the average error vector, not the average of errors
+      return {'num':self.num, 'avg err':float(Dist(self.mean, self.ref)), 'max':self.maxDist}
+    else:
+      return {'num':0, 'avg err':0, 'max':0}
+
+  def precisionStats(self):
+    if self.num > 0:
+      return {'num':self.num, 'span':self.spanTracker.span, 'rms':self.rms()}
+    else:
+      return {'num':0, 'span':0, 'rms':0}
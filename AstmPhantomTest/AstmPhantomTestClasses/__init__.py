@@ -1,5 +1,12 @@
-from .Pointer import *
-from .Phantom import *
-from .Measurements import *
-from .Targets import *
-from .WorkingVolume import *
\ No newline at end of file
+import importlib.util
+from .Profiler import *
+from .PointerCore import *
+# the other classes depend on Slicer and VTK: without them, e.g. for headless replay
+# in worker processes, only the pointer core is available
+if importlib.util.find_spec('vtk') and importlib.util.find_spec('slicer'):
+  from .TrackerStream import *
+  from .Pointer import *
+  from .Phantom import *
+  from .Measurements import *
+  from .Targets import *
+  from .WorkingVolume import *
\ No newline at end of file